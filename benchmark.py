@@ -0,0 +1,135 @@
+# Benchmarks for the ttf -> hershey pipeline
+# (c) Lingdong Huang 2018
+
+# Times each stage (parse, cmap, flatten, encode) separately and
+# end to end, and reports the results as JSON. A saved report can
+# be used as a baseline to catch performance regressions.
+#
+# python benchmark.py [fonts...] [-o report.json] [-b baseline.json]
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+from truetype.truetype import *
+from ttf2hershey import hersheyscale, hersheyencode, tohershey
+
+DEFAULT_FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)),"ttf","Ubuntu.ttf")
+DEFAULT_TEXT = "".join([chr(i) for i in range(32,128)])
+
+def peak_rss():
+    # peak resident memory of the whole run, in KB. it only ever
+    # grows, so it is reported once rather than per stage
+    # (tracemalloc is not available on python 2)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def timed(fn,repeat):
+    # best wall time of `repeat` runs, and the result of the last one
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        result = fn()
+        dt = time.time()-t
+        best = dt if best is None else min(best,dt)
+    return best, result
+
+def record(font,stage,seconds,glyphs=0,vertices=0,**settings):
+    r = {"font":os.path.basename(font),"stage":stage,"seconds":seconds,
+         "glyphs_per_sec":glyphs/seconds if seconds else 0,
+         "vertices_per_sec":vertices/seconds if seconds else 0}
+    r.update(settings)
+    return r
+
+def count_vertices(glyphs):
+    return sum(len(c) for g in glyphs for c in g['poly'])
+
+def bench_font(path,text=DEFAULT_TEXT,precisions=(0,3,10),kerns=(0,2),repeat=3):
+    results = []
+    raw = open(path,'rb').read()
+
+    t, head = timed(lambda: ttfparser.TTFFile(raw),repeat)
+    results.append(record(path,"parse",t,glyphs=head.length))
+
+    ttf = TrueTypeFont(path,verbose=False,lazy=True)
+    def cmap():
+        ttf.cmapCache = {}
+        ttf.compileCmap()
+        return [ttf.chr2idx(ch) for ch in text]
+    t, indices = timed(cmap,repeat)
+    results.append(record(path,"cmap",t,glyphs=len(text)))
+
+    for p in precisions:
+        ttf = TrueTypeFont(path,precision=p,verbose=False,lazy=True)
+        def flatten():
+            # start without compiled components, so each run compiles
+            # compound glyphs from scratch at this precision
+            ttf.glyphCache = GlyphCache(ttf.compileGlyph,ttf.ttf.length)
+            ttf.pointCache = {}
+            return [ttf.compileGlyph(i) for i in xrange(ttf.ttf.length)]
+        t, glyphs = timed(flatten,repeat)
+        results.append(record(path,"flatten",t,glyphs=len(glyphs),
+                              vertices=count_vertices(glyphs),precision=p))
+
+        used = [glyphs[i] for i in indices]
+        for k in kerns:
+            scale = hersheyscale(ttf.ttf,k,ttf.baseline)
+            def encode():
+                for g in used:
+                    xmin,ymin,xmax,ymax = g['rect']
+                    hersheyencode(g['poly'],xmin+(xmax-xmin)/2.0,ttf.baseline,scale)
+            t, _ = timed(encode,repeat)
+            results.append(record(path,"encode",t,glyphs=len(used),
+                                  vertices=count_vertices(used),precision=p,kern=k))
+
+    for k in kerns:
+        t, _ = timed(lambda: tohershey(text,font_path=path,kern=k,verbose=False),repeat)
+        results.append(record(path,"end_to_end",t,glyphs=len(text),kern=k))
+    return results
+
+def key(r):
+    return (r["font"],r["stage"],r.get("precision"),r.get("kern"))
+
+def compare(results,baseline,threshold=0.25):
+    # results that got slower than the baseline by more than threshold
+    base = dict((key(r),r) for r in baseline)
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is not None and b["seconds"] > 0 and r["seconds"] > b["seconds"]*(1+threshold):
+            regressions.append({"key":list(key(r)),"baseline":b["seconds"],
+                                "seconds":r["seconds"],"ratio":r["seconds"]/b["seconds"]})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ttf -> hershey pipeline")
+    parser.add_argument("fonts",nargs="*",help="fonts to benchmark (default: ttf/Ubuntu.ttf)")
+    parser.add_argument("-p","--precision",default="0,3,10",help="comma separated precisions")
+    parser.add_argument("-k","--kern",default="0,2",help="comma separated kern values")
+    parser.add_argument("-r","--repeat",type=int,default=3,help="runs per measurement, best is kept")
+    parser.add_argument("-o","--output",help="write the JSON report here instead of stdout")
+    parser.add_argument("-b","--baseline",help="compare against a saved JSON report")
+    parser.add_argument("--threshold",type=float,default=0.25,
+                        help="allowed slowdown against the baseline (default 0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    precisions = [int(x) for x in args.precision.split(",")]
+    kerns = [int(x) for x in args.kern.split(",")]
+    results = []
+    for path in args.fonts or [DEFAULT_FONT]:
+        results += bench_font(path,precisions=precisions,kerns=kerns,repeat=args.repeat)
+
+    report = {"results":results,"peak_rss_kb":peak_rss()}
+    if args.baseline:
+        report["regressions"] = compare(results,json.load(open(args.baseline))["results"],
+                                        args.threshold)
+    out = json.dumps(report,indent=2,sort_keys=True)
+    if args.output:
+        open(args.output,"w").write(out+"\n")
+    else:
+        print out
+    return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
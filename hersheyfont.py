@@ -0,0 +1,189 @@
+# Read Hershey fonts (.hf.txt) as produced by ttf2hershey
+# (c) Lingdong Huang 2018
+
+# A font is parsed once into flat arrays: every vertex of every glyph
+# in one (V,2) array, with offset arrays marking where each stroke and
+# each glyph starts. Glyphs are looked up by codepoint in O(1).
+#
+# font = HersheyFont.load("hershey/Ubuntu.hf.txt")
+# left, right, strokes = font[u"A"]
+#
+# Coordinates are hershey units relative to the glyph center, with y
+# pointing down, as in the file. With sidecar=True the arrays are also
+# saved next to the font (<path>.idx) and memory-mapped on later loads,
+# so several processes opening the same font share its pages.
+
+import os
+import numpy as np
+from numpy.lib import format as npformat
+from truetype.ttfparser import mapFile
+
+# bump whenever the sidecar layout changes
+VERSION = 1
+ORIGIN = ord('R')
+FIELDS = ("codepoints","bounds","glyphOffsets","strokeOffsets","vertices")
+
+def readrecords(data):
+    # split a hershey file into (codepoint, body) records. a record's
+    # body may be wrapped over several lines, so it is read by length:
+    # ttf2hershey writes the number of characters in the body, classic
+    # hershey files the number of vertex pairs, which is detected from
+    # the first record that fits on one line.
+    lines = data.split("\n")
+    records = []
+    width = None
+    i = 0
+    while i < len(lines):
+        line = lines[i].rstrip("\r")
+        i += 1
+        if not line.strip():
+            continue
+        code, count, body = int(line[:5]), int(line[5:8]), line[8:]
+        if width is None and len(body) < 72 and len(body) in (count,2*count):
+            width = 1 if len(body) == count else 2
+        need = count*(width or 1)
+        while len(body) < need and i < len(lines):
+            body += lines[i].rstrip("\r")
+            i += 1
+        records.append((code,body[:need]))
+    return records
+
+class HersheyFont(object):
+    def __init__(self, codepoints, bounds, glyphOffsets, strokeOffsets, vertices):
+        self.codepoints = codepoints
+        self.bounds = bounds
+        self.glyphOffsets = glyphOffsets
+        self.strokeOffsets = strokeOffsets
+        self.vertices = vertices
+        self.index = dict((c,i) for i,c in enumerate(codepoints.tolist()))
+
+    @classmethod
+    def parse(cls, data):
+        # decode all records in one pass over their concatenated bodies
+        records = readrecords(data)
+        codepoints = np.array([c for c,_ in records],dtype=np.int32)
+        sizes = np.array([len(b)//2 for _,b in records],dtype=np.int64)
+        body = "".join(b[:2*n] for (_,b),n in zip(records,sizes))
+        pairs = np.frombuffer(body,dtype=np.uint8).reshape(-1,2).astype(np.int16)-ORIGIN
+
+        starts = np.cumsum(sizes)-sizes
+        isBound = np.zeros(len(pairs),dtype=bool)
+        isBound[starts[sizes > 0]] = True
+        isPenup = pairs[:,0] == ord(' ')-ORIGIN
+        isVertex = ~(isBound | isPenup)
+        # a stroke starts at any vertex following the bounds or a pen-up
+        follows = np.concatenate([[True],~isVertex[:-1]])
+        strokeStarts = np.nonzero(isVertex & follows)[0]
+
+        vertexIndex = np.cumsum(isVertex)-isVertex
+        strokeOffsets = np.append(vertexIndex[strokeStarts],np.count_nonzero(isVertex))
+        glyphOffsets = np.append(np.searchsorted(strokeStarts,starts),len(strokeStarts))
+
+        bounds = np.zeros((len(records),2),dtype=np.int8)
+        bounds[sizes > 0] = pairs[starts[sizes > 0]]
+        return cls(codepoints,bounds,glyphOffsets.astype(np.int64),
+                   strokeOffsets.astype(np.int64),pairs[isVertex].astype(np.int8))
+
+    @classmethod
+    def load(cls, path, sidecar=False):
+        # parse the font at path. with sidecar, map <path>.idx instead
+        # when it is up to date, and write it when it is not
+        if sidecar:
+            font = cls.open(path+".idx",path)
+            if font is not None:
+                return font
+        f = open(path,"rb")
+        try:
+            font = cls.parse(f.read())
+        finally:
+            f.close()
+        if sidecar:
+            font.save(path+".idx",path)
+            font = cls.open(path+".idx",path) or font
+        return font
+
+    def save(self, path, source=None):
+        # write the arrays as consecutive .npy records, headed by the
+        # size and mtime of the source file they were parsed from
+        meta = [VERSION,0,0]
+        if source is not None:
+            st = os.stat(source)
+            meta = [VERSION,st.st_size,st.st_mtime]
+        tmp = path+".tmp"+str(os.getpid())
+        f = open(tmp,"wb")
+        try:
+            npformat.write_array(f,np.array(meta,dtype=np.float64))
+            for k in FIELDS:
+                npformat.write_array(f,np.ascontiguousarray(getattr(self,k)))
+        finally:
+            f.close()
+        os.rename(tmp,path)
+
+    @classmethod
+    def open(cls, path, source=None):
+        # memory-map a saved font. returns None if there is none, or
+        # if it is stale with respect to the source file
+        try:
+            buf = mapFile(path)
+        except (IOError,OSError,ValueError):
+            return None
+        arrays = []
+        pos = 0
+        try:
+            for _ in range(len(FIELDS)+1):
+                header = buf[pos:pos+4096]
+                f = _Reader(header)
+                if npformat.read_magic(f) == (1,0):
+                    shape, fortran, dtype = npformat.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = npformat.read_array_header_2_0(f)
+                pos += f.pos
+                count = int(np.prod(shape))
+                arrays.append(np.frombuffer(buf,dtype=dtype,count=count,offset=pos).reshape(shape))
+                pos += count*dtype.itemsize
+        except (ValueError,TypeError):
+            return None
+        meta = arrays.pop(0)
+        if meta[0] != VERSION:
+            return None
+        if source is not None:
+            st = os.stat(source)
+            if (meta[1],meta[2]) != (st.st_size,st.st_mtime):
+                return None
+        return cls(*arrays)
+
+    def __len__(self):
+        return len(self.codepoints)
+
+    def __contains__(self, ch):
+        return _codepoint(ch) in self.index
+
+    def __iter__(self):
+        for c in self.codepoints.tolist():
+            yield c
+
+    def __getitem__(self, ch):
+        # (left, right, strokes) of a character or codepoint,
+        # strokes being (M,2) views into the vertex array
+        i = self.index[_codepoint(ch)]
+        s = self.strokeOffsets
+        left, right = self.bounds[i].tolist()
+        return left, right, [self.vertices[s[j]:s[j+1]]
+                             for j in xrange(self.glyphOffsets[i],self.glyphOffsets[i+1])]
+
+    def nbytes(self):
+        return sum(getattr(self,k).nbytes for k in FIELDS)
+
+def _codepoint(ch):
+    return ch if isinstance(ch,(int,long)) else ord(ch)
+
+class _Reader(object):
+    # minimal file interface over a buffer, for numpy's header parser
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, n):
+        s = self.data[self.pos:self.pos+n]
+        self.pos += len(s)
+        return s
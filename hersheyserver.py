@@ -0,0 +1,191 @@
+# HTTP service converting text to Hershey fonts
+# (c) Lingdong Huang 2018
+
+# Serves the fonts found in one or more directories, by id (file name
+# without extension):
+#
+#   GET /convert?font=Ubuntu&text=Hello&kern=0   hershey records (text/plain)
+#   GET /fonts                                   available font ids (JSON)
+#   GET /stats                                   queue depth and latency (JSON)
+#
+# Fonts are converted in a process pool so that compiling a glyph never
+# holds up other requests. Each worker keeps a bounded LRU pool of loaded
+# fonts, keyed by path and modification time.
+#
+# python hersheyserver.py [font dirs...] [--port 8000] [--jobs N]
+
+import os
+import sys
+import glob
+import json
+import time
+import urlparse
+import argparse
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from ttf2hershey import HersheyConverter
+
+DEFAULT_FONTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),"ttf")
+# hersheyscale fits the font in 2*(36-kern) units, so no kern beyond this
+MAX_KERN = 35
+
+class FontPool():
+    # bounded LRU of HersheyConverters. a font is reloaded
+    # when its file changes, since mtime is part of the key
+    def __init__(self,maxsize=8):
+        self.maxsize = maxsize
+        self.fonts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,path,kern=0):
+        key = (path,os.path.getmtime(path),kern)
+        with self.lock:
+            converter = self.fonts.pop(key,None)
+            if converter is None:
+                converter = HersheyConverter(path,kern=kern,verbose=False)
+            self.fonts[key] = converter
+            while len(self.fonts) > self.maxsize:
+                self.fonts.popitem(last=False)
+            return converter
+
+_pool = None
+
+def _init_worker(maxsize):
+    global _pool
+    _pool = FontPool(maxsize)
+
+def _convert(path,kern,text):
+    return _pool.get(path,kern).convert(text)
+
+class HersheyServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+
+    def __init__(self,address,font_dirs=(DEFAULT_FONTS,),jobs=None,pool_size=8,timeout=60):
+        HTTPServer.__init__(self,address,HersheyHandler)
+        self.fonts = {}
+        for d in font_dirs:
+            for p in sorted(glob.glob(os.path.join(d,"*.ttf"))):
+                self.fonts[os.path.splitext(os.path.basename(p))[0]] = os.path.abspath(p)
+        self.timeout = timeout
+        if jobs == 0:
+            # convert on the request threads, e.g. for debugging
+            self.workers = None
+            _init_worker(pool_size)
+        else:
+            self.workers = multiprocessing.Pool(jobs,_init_worker,(pool_size,))
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.maxLatency = 0.0
+
+    def convert(self,font,text,kern=0):
+        path = self.fonts[font]
+        with self.lock:
+            self.queued += 1
+        t = time.time()
+        ok = False
+        try:
+            if self.workers is None:
+                result = _convert(path,kern,text)
+            else:
+                result = self.workers.apply_async(_convert,(path,kern,text)).get(self.timeout)
+            ok = True
+            return result
+        finally:
+            dt = time.time()-t
+            with self.lock:
+                self.queued -= 1
+                self.requests += 1
+                self.errors += not ok
+                self.seconds += dt
+                self.maxLatency = max(self.maxLatency,dt)
+
+    def info(self):
+        with self.lock:
+            return {"queued":self.queued,"requests":self.requests,"errors":self.errors,
+                    "mean_latency":self.seconds/self.requests if self.requests else 0.0,
+                    "max_latency":self.maxLatency,"fonts":len(self.fonts)}
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self.workers is not None:
+            self.workers.terminate()
+            self.workers.join()
+
+class HersheyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.route(url.path,urlparse.parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.getheader("content-length") or 0)
+        params = urlparse.parse_qs(url.query)
+        params.update(urlparse.parse_qs(self.rfile.read(length)))
+        self.route(url.path,params)
+
+    def route(self,path,params):
+        if path == "/fonts":
+            return self.reply(200,json.dumps(sorted(self.server.fonts.keys())),"application/json")
+        if path == "/stats":
+            return self.reply(200,json.dumps(self.server.info()),"application/json")
+        if path != "/convert":
+            return self.reply(404,"not found\n")
+
+        font = params.get("font",[None])[0]
+        if font not in self.server.fonts:
+            return self.reply(404,"unknown font: %s\n" % font)
+        try:
+            text = params.get("text",[""])[0].decode("utf-8")
+            kern = int(params.get("kern",["0"])[0])
+        except ValueError:
+            return self.reply(400,"bad text or kern\n")
+        if not 0 <= kern <= MAX_KERN:
+            return self.reply(400,"kern must be between 0 and %d\n" % MAX_KERN)
+        try:
+            result = self.server.convert(font,text,kern)
+        except Exception:
+            # the details stay in the server's log
+            sys.stderr.write(traceback.format_exc())
+            return self.reply(500,"conversion failed\n")
+        self.reply(200,result)
+
+    def reply(self,code,body,content_type="text/plain"):
+        self.send_response(code)
+        self.send_header("Content-Type",content_type)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve ttf -> hershey conversions over HTTP")
+    parser.add_argument("fonts",nargs="*",help="font directories (default: ttf/)")
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("-p","--port",type=int,default=8000)
+    parser.add_argument("-j","--jobs",type=int,default=None,
+                        help="worker processes (default: all cores, 0: convert in-process)")
+    parser.add_argument("--pool-size",type=int,default=8,help="fonts kept loaded per worker")
+    args = parser.parse_args(argv)
+
+    server = HersheyServer((args.host,args.port),args.fonts or [DEFAULT_FONTS],
+                           jobs=args.jobs,pool_size=args.pool_size)
+    sys.stderr.write("serving %d fonts on http://%s:%d/\n" % (len(server.fonts),args.host,args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# persistent cache of compiled glyphs, so that converting
+# the same font again skips parsing and flattening
+
+import os
+import glob
+import hashlib
+import numpy as np
+from glyphstore import GlyphStore
+
+# bump whenever the compiled glyph format or flattening changes
+VERSION = 2
+
+def fontHash(raw):
+    return hashlib.sha1(raw).hexdigest()
+
+def cachePath(directory, fontHash, settings):
+    key = hashlib.sha1(repr((VERSION, fontHash)+tuple(settings))).hexdigest()
+    return os.path.join(directory, key+".npz")
+
+def saveGlyphs(path, store, cmap):
+    # store is a GlyphStore, cmap a dict of arrays
+    arrays = store.toArrays()
+    for k, v in cmap.items():
+        arrays["cmap_"+k] = v
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path+".tmp"+str(os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        np.savez(f, **arrays)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def loadGlyphs(path):
+    # returns (GlyphStore, cmap) or None when there is no usable entry
+    if not os.path.exists(path):
+        return None
+    try:
+        data = np.load(path)
+        store = GlyphStore.fromArrays(data)
+        cmap = dict((k[5:], data[k]) for k in data.files if k.startswith("cmap_"))
+    except Exception:
+        return None
+    # mark as recently used for eviction
+    os.utime(path, None)
+    return store, cmap
+
+def evict(directory, limit, keep=None):
+    # delete least recently used entries until the directory
+    # holds at most limit bytes, never removing keep
+    entries = []
+    for p in glob.glob(os.path.join(directory, "*.npz")):
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    entries.sort(reverse=True)
+    total = 0
+    if keep is not None and os.path.exists(keep):
+        total = os.path.getsize(keep)
+    for mtime, size, p in entries:
+        if p == keep:
+            continue
+        total += size
+        if total > limit:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
@@ -3,6 +3,8 @@
 # parse glyphs as curves
 # (c) Lingdong Huang 2018
 
+import numpy as np
+
 def lerp(p0,p1,t):
     x = (1-t) * p0[0] + t * p1[0]
     y = (1-t) * p0[1] + t * p1[1]
@@ -16,36 +18,273 @@ def high_bezier(pts,t):
     else:
         return lerp(high_bezier(pts[:-1], t), high_bezier(pts[1:], t), t)
 
-def construct_curve(pts, precision=10, maxhandle=5):
+_bernstein = {}
+
+def sample_matrix(degree, n):
+    # (n, degree+1) matrix whose rows are the bernstein weights at
+    # t = 0, 1/n, ... (n-1)/n, so that sampling a curve is a single
+    # matrix multiply.
+    key = (degree, n)
+    if key not in _bernstein:
+        t = np.arange(n, dtype=float)[:,None]/float(n)
+        k = np.arange(degree+1)
+        binom = np.array([1.0])
+        for i in range(degree):
+            binom = np.append(binom,0) + np.append(0,binom)
+        _bernstein[key] = binom * t**k * (1-t)**(degree-k)
+    return _bernstein[key]
+
+def bernstein_matrix(degree, precision):
+    return sample_matrix(degree, precision*(degree+1))
+
+def subdivisions(ctrl, tolerance):
+    # number of uniform steps needed to keep each curve in ctrl
+    # (S, degree+1, 2) within tolerance of its chords, from the
+    # bound n(n-1)/8 * max|P[i]-2P[i+1]+P[i+2]| on a degree n bezier
+    degree = ctrl.shape[1]-1
+    if degree < 2:
+        return np.ones(len(ctrl), dtype=int)
+    dd = ctrl[:,2:]-2*ctrl[:,1:-1]+ctrl[:,:-2]
+    L = np.sqrt((dd**2).sum(axis=2)).max(axis=1)
+    steps = np.ceil(np.sqrt(degree*(degree-1)/8.0 * L / tolerance))
+    return np.maximum(steps, 1).astype(int)
+
+def split_contour(onCurve, maxhandle=5):
+    # walk a contour's on/off-curve flags and cut it into pieces:
+    # (True, indices) for bezier segments to be sampled,
+    # (False, indices) for points passed through as is.
+    pieces = []
     buff = []
-    curve = []
+    last = len(onCurve)-1
     def flush():
-        n = precision*len(buff)
-        for j in range(0,n):
-            t = float(j)/float(n)
-            curve.append(high_bezier(buff,t))
+        if 1 < len(buff) <= maxhandle+2:
+            pieces.append((True, buff))
+        else:
+            pieces.append((False, buff))
 
-    for i in range(len(pts)):
-        x,y = pts[i]['x'], pts[i]['y']
-        buff.append([x,y])
+    for i in range(len(onCurve)):
+        buff.append(i)
 
-        if pts[i]['onCurve']:
+        if onCurve[i]:
             if 1 < len(buff) <= maxhandle+2:
                 flush()
-                buff = [[x,y]]
+                buff = [i]
             else:
-                curve += buff
+                pieces.append((False, buff))
                 buff = []
         elif i == 0:
-            buff = [[pts[-1]['x'],pts[-1]['y']]]+buff
-        elif i == len(pts)-1:
-            buff += [[pts[0]['x'],pts[0]['y']]]
-            if 1 < len(buff) <= maxhandle+2:
-                flush()
-            else:
-                curve += buff
+            buff = [last]+buff
+        elif i == last:
+            buff += [0]
+            flush()
             buff = []
-    curve += buff
-    curve = [[c[0],c[1]] for c in curve]
+    pieces.append((False, buff))
+    return pieces
+
+def quadratic_segments(coords, onCurve):
+    # cut one closed truetype contour into its quadratic segments
+    # (S,3,2): an on-curve point is implied midway between consecutive
+    # off-curve points, and a straight segment becomes a quadratic with
+    # its control point at its middle.
+    coords = np.asarray(coords, dtype=float).reshape(-1,2)
+    on = np.asarray(onCurve, dtype=bool)
+    if len(coords) == 0:
+        return np.zeros((0,3,2))
+    if on.any():
+        # start at the first on-curve point
+        k = int(np.argmax(on))
+        coords, on = np.roll(coords, -k, axis=0), np.roll(on, -k)
+    else:
+        coords = np.concatenate([(coords[-1:]+coords[:1])/2.0, coords])
+        on = np.concatenate([[True], on])
+    pts = np.concatenate([coords, coords[:1]])
+    on = np.append(on, True)
+    between = np.nonzero(~on[:-1] & ~on[1:])[0]+1
+    pts = np.insert(pts, between, (pts[between-1]+pts[between])/2.0, axis=0)
+    on = np.insert(on, between, True)
+
+    start = np.nonzero(on)[0][:-1]
+    curved = ~on[start+1]
+    end = np.where(curved, start+2, start+1)
+    ctrl = np.where(curved[:,None], pts[start+1], (pts[start]+pts[end])/2.0)
+    return np.stack([pts[start], ctrl, pts[end]], axis=1)
+
+def flatten_glyph(coords, onCurve, contourEnds, precision=10, maxhandle=5,
+                  tolerance=None):
+    # flatten every contour of a glyph at once. segments of the same
+    # degree across the whole glyph are sampled in one batch.
+    # with a tolerance, the contours are flattened by their quadratic
+    # segments instead, each getting only as many samples as needed
+    # to stay within that chordal error (maxhandle is then unused).
+    # returns one (M,2) float array per contour.
+    if tolerance is not None:
+        return flatten_quadratics(coords, onCurve, contourEnds, tolerance)
+    coords = np.asarray(coords, dtype=float)
+    contours = []
+    batches = {}
+    e0 = 0
+    for e1 in contourEnds:
+        e1 += 1
+        pieces = []
+        for bezier, idx in split_contour(onCurve[e0:e1], maxhandle):
+            idx = [e0+j for j in idx]
+            if bezier:
+                batch = batches.setdefault(len(idx), [])
+                pieces.append((len(idx), len(batch)))
+                batch.append(idx)
+            else:
+                pieces.append(coords[idx].reshape(-1,2))
+        contours.append(pieces)
+        e0 = e1
+
+    samples = {}
+    for n, idx in batches.items():
+        B = bernstein_matrix(n-1, precision)
+        samples[n] = list(np.einsum('jk,skc->sjc', B, coords[np.array(idx)]))
+
+    result = []
+    for pieces in contours:
+        result.append(np.concatenate([samples[p[0]][p[1]] if type(p) is tuple else p
+                                      for p in pieces] or [np.zeros((0,2))]))
+    return result
+
+def flatten_quadratics(coords, onCurve, contourEnds, tolerance):
+    # the quadratics of all contours are sampled in batches of the
+    # same number of steps. each contour starts at its first on-curve
+    # point and is left open, its last sample before that point.
+    coords = np.asarray(coords, dtype=float)
+    segments = []
+    e0 = 0
+    for e1 in contourEnds:
+        e1 += 1
+        segments.append(quadratic_segments(coords[e0:e1], onCurve[e0:e1]))
+        e0 = e1
+    ctrl = np.concatenate(segments) if segments else np.zeros((0,3,2))
+    steps = subdivisions(ctrl, tolerance)
+    samples = [None]*len(ctrl)
+    for m in np.unique(steps):
+        sel = np.nonzero(steps == m)[0]
+        curves = np.einsum('jk,skc->sjc', sample_matrix(2, m), ctrl[sel])
+        for s, curve in zip(sel, curves):
+            samples[s] = curve
+
+    result = []
+    e0 = 0
+    for seg in segments:
+        e1 = e0+len(seg)
+        result.append(np.concatenate(samples[e0:e1] or [np.zeros((0,2))]))
+        e0 = e1
+    return result
+
+def construct_curve(pts, precision=10, maxhandle=5, tolerance=None):
+    coords = [[p['x'],p['y']] for p in pts]
+    onCurve = [p['onCurve'] for p in pts]
+    curve = flatten_glyph(coords, onCurve, [len(pts)-1], precision, maxhandle,
+                          tolerance)[0]
+    return curve.tolist()
+
+def simplify_polyline(pts, epsilon):
+    # drop consecutive duplicates, then Ramer-Douglas-Peucker: keep
+    # only the vertices further than epsilon from the chord they would
+    # be replaced by. endpoints are always kept, so a closed contour
+    # (first point == last) stays closed.
+    pts = np.asarray(pts, dtype=float)
+    if len(pts) < 2:
+        return pts
+    moved = np.any(pts[1:] != pts[:-1], axis=1)
+    pts = pts[np.concatenate([[True], moved])]
+    if len(pts) < 3:
+        return pts
+
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(pts)-1)]
+    while stack:
+        i, j = stack.pop()
+        if j-i < 2:
+            continue
+        a, b = pts[i], pts[j]
+        d = pts[i+1:j]-a
+        ab = b-a
+        norm = np.hypot(ab[0], ab[1])
+        if norm == 0:
+            dist = np.hypot(d[:,0], d[:,1])
+        else:
+            dist = np.abs(ab[0]*d[:,1]-ab[1]*d[:,0])/norm
+        k = int(np.argmax(dist))
+        if dist[k] > epsilon:
+            k += i+1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return pts[keep]
+
+def path_travel(points):
+    # length of the pen-up moves visiting points in order
+    points = np.asarray(points, dtype=float).reshape(-1,2)
+    return float(np.hypot(*(points[1:]-points[:-1]).T).sum())
+
+def order_contours(contours, passes=2):
+    # reorder closed polylines (first point == last) and rotate their
+    # start points so that less pen-up travel is needed between them:
+    # nearest neighbour from the leftmost point, then alternating 2-opt
+    # on the order and re-picking each contour's start point between its
+    # neighbours. returns the contours, and the travel before and after.
+    n = len(contours)
+    before = path_travel([c[0] for c in contours]) if n else 0.0
+    if n < 2:
+        return contours, before, before
+    rings = [np.asarray(c[:-1] if len(c) > 1 else c, dtype=float) for c in contours]
+    pts = np.concatenate(rings)
+    owner = np.repeat(np.arange(n), [len(r) for r in rings])
+    first = np.cumsum([0]+[len(r) for r in rings[:-1]])
+
+    # nearest neighbour: order[k] is a contour, entry[k] an index into pts
+    cur = int(np.argmin(pts[:,0]))
+    order, entry = [owner[cur]], [cur]
+    left = np.ones(n, dtype=bool)
+    left[owner[cur]] = False
+    for _ in range(n-1):
+        d = ((pts-pts[cur])**2).sum(1)
+        d[~left[owner]] = np.inf
+        cur = int(np.argmin(d))
+        order.append(owner[cur])
+        entry.append(cur)
+        left[owner[cur]] = False
+
+    dist = lambda a, b: np.hypot(*(pts[a]-pts[b]))
+    for _ in range(passes):
+        improved = True
+        while improved:
+            improved = False
+            for i in range(n-1):
+                for j in range(i+1, n):
+                    # reverse entry[i..j]
+                    old = new = 0.0
+                    if i > 0:
+                        old += dist(entry[i-1], entry[i])
+                        new += dist(entry[i-1], entry[j])
+                    if j < n-1:
+                        old += dist(entry[j], entry[j+1])
+                        new += dist(entry[i], entry[j+1])
+                    if new < old-1e-9:
+                        order[i:j+1] = order[i:j+1][::-1]
+                        entry[i:j+1] = entry[i:j+1][::-1]
+                        improved = True
+        for k in range(n):
+            r = rings[order[k]]
+            d = np.zeros(len(r))
+            if k > 0:
+                d += np.hypot(*(r-pts[entry[k-1]]).T)
+            if k < n-1:
+                d += np.hypot(*(r-pts[entry[k+1]]).T)
+            entry[k] = first[order[k]]+int(np.argmin(d))
 
-    return curve
+    after = path_travel(pts[entry])
+    if after >= before:
+        return contours, before, before
+    result = []
+    for c, e in zip(order, entry):
+        r = np.roll(rings[c], first[c]-e, axis=0)
+        result.append(np.concatenate([r, r[:1]]) if len(contours[c]) > 1 else r)
+    return result, before, after
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# compact storage for a font's compiled glyphs: one flat
+# coordinate array for the whole font, with offset arrays
+# marking where each contour and each glyph starts
+
+import numpy as np
+
+class Glyph(object):
+    # lightweight view of one glyph in a GlyphStore.
+    # glyph['rect'] and glyph['poly'] still work like the
+    # dicts returned by TrueTypeFont.compileGlyph
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def rect(self):
+        return tuple(self.store.rects[self.index].tolist())
+
+    @property
+    def contours(self):
+        # (M,2) array view per contour
+        s = self.store
+        c0, c1 = s.glyphOffsets[self.index], s.glyphOffsets[self.index+1]
+        return [s.coords[s.contourOffsets[i]:s.contourOffsets[i+1]]
+                for i in xrange(c0, c1)]
+
+    def __len__(self):
+        return int(self.store.glyphOffsets[self.index+1]-self.store.glyphOffsets[self.index])
+
+    def __iter__(self):
+        return iter(self.contours)
+
+    def __getitem__(self, key):
+        if key == 'rect':
+            return self.rect
+        if key == 'poly':
+            return [c.tolist() for c in self.contours]
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        return self['rect'] == other['rect'] and self['poly'] == other['poly']
+
+    def __ne__(self, other):
+        return not self == other
+
+class GlyphStore(object):
+    def __init__(self, rects, glyphOffsets, contourOffsets, coords):
+        self.rects = rects
+        self.glyphOffsets = glyphOffsets
+        self.contourOffsets = contourOffsets
+        self.coords = coords
+
+    @classmethod
+    def fromGlyphs(cls, glyphs):
+        # pack an iterable of {"rect":..., "poly":...} dicts
+        rects = []
+        glyphOffsets = [0]
+        contourLengths = [0]
+        coords = []
+        for g in glyphs:
+            rects.append(g['rect'])
+            glyphOffsets.append(glyphOffsets[-1]+len(g['poly']))
+            for c in g['poly']:
+                contourLengths.append(len(c))
+                if len(c):
+                    coords.append(np.asarray(c))
+        coords = np.concatenate(coords) if coords else np.zeros((0,2))
+        if coords.dtype.kind in 'iu':
+            # unflattened outlines are plain font units
+            coords = coords.astype(np.int32)
+        return cls(np.array(rects, dtype=np.int32).reshape(-1,4),
+                   np.array(glyphOffsets, dtype=np.int64),
+                   np.cumsum(contourLengths, dtype=np.int64),
+                   coords.reshape(-1,2))
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        return cls(arrays["rects"], arrays["glyphOffsets"],
+                   arrays["contourOffsets"], arrays["coords"])
+
+    def toArrays(self):
+        return {
+            "rects": self.rects,
+            "glyphOffsets": self.glyphOffsets,
+            "contourOffsets": self.contourOffsets,
+            "coords": self.coords,
+        }
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError("glyph index out of range")
+        return Glyph(self, index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield Glyph(self, i)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.toArrays().values())
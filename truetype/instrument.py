@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# timing and profiling hooks for the conversion pipeline.
+# pass a Stats object as TrueTypeFont(stats=...) to record how long
+# each stage takes; without one the pipeline skips all of this.
+
+import cProfile
+import pstats
+from timeit import default_timer
+
+class Stats():
+    # records count, total and worst duration per stage, and which
+    # item (e.g. glyph index) was the worst. callback, if given, is
+    # called as callback(stage, seconds, key) for every measurement.
+    # profile names a stage ("read", "parse", "cmap", "glyph",
+    # "flatten" or "encode") to run under cProfile.
+    def __init__(self, callback=None, profile=None):
+        self.callback = callback
+        self.profile = profile
+        self.profiler = cProfile.Profile() if profile else None
+        self.depth = 0
+        self.stages = {}
+
+    def start(self, stage):
+        if stage == self.profile:
+            self.depth += 1
+            if self.depth == 1:
+                self.profiler.enable()
+        return default_timer()
+
+    def stop(self, stage, t, key=None, name=None):
+        # name, if given, is recorded instead of stage, e.g. to
+        # split "glyph" into "glyph.simple" and "glyph.compound"
+        seconds = default_timer()-t
+        if stage == self.profile:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profiler.disable()
+        self.add(name or stage, seconds, key)
+
+    def add(self, stage, seconds, key=None):
+        s = self.stages.get(stage)
+        if s is None:
+            s = self.stages[stage] = {"count":0, "seconds":0.0, "max":0.0, "maxKey":None}
+        s["count"] += 1
+        s["seconds"] += seconds
+        if seconds >= s["max"]:
+            s["max"] = seconds
+            s["maxKey"] = key
+        if self.callback is not None:
+            self.callback(stage, seconds, key)
+
+    def report(self):
+        return dict((k, dict(v)) for k, v in self.stages.items())
+
+    def printProfile(self, sort="cumulative", limit=20):
+        if self.profiler is not None:
+            pstats.Stats(self.profiler).sort_stats(sort).print_stats(limit)
+
+    def __str__(self):
+        lines = ["%-16s %8s %10s %10s  %s" % ("stage", "count", "seconds", "max", "worst")]
+        for k in sorted(self.stages):
+            s = self.stages[k]
+            lines.append("%-16s %8d %10.4f %10.4f  %s" % (
+                k, s["count"], s["seconds"], s["max"], s["maxKey"]))
+        return "\n".join(lines)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# writers for polylines laid out by TrueTypeFont.render:
+# SVG for previews, G-code for plotters and engravers.
+# polylines are (M,2) arrays with y pointing up.
+
+import numpy as np
+
+def bounds(polylines):
+    if not polylines:
+        return 0.0, 0.0, 0.0, 0.0
+    pts = np.concatenate(polylines)
+    xmin, ymin = pts.min(0)
+    xmax, ymax = pts.max(0)
+    return xmin, ymin, xmax, ymax
+
+def formatPoints(pts, fmt):
+    # format all points of a polyline with one % operation
+    return (fmt*len(pts)) % tuple(pts.ravel().tolist())
+
+def writeSVG(f, polylines, margin=0, stroke="black", strokeWidth=1, digits=2):
+    # one path for all polylines, flipped so that y points down,
+    # in a viewBox fitting them with margin around
+    xmin, ymin, xmax, ymax = bounds(polylines)
+    width, height = xmax-xmin+2*margin, ymax-ymin+2*margin
+    f.write('<svg xmlns="http://www.w3.org/2000/svg" viewBox="%g %g %g %g" width="%g" height="%g">\n'
+            % (xmin-margin, -ymax-margin, width, height, width, height))
+    f.write('<path fill="none" stroke="%s" stroke-width="%g" d="' % (stroke, strokeWidth))
+    point = "%%.%df %%.%df " % (digits, digits)
+    for p in polylines:
+        if len(p):
+            q = p*(1,-1)+0.0
+            f.write("M"+formatPoints(q[:1], point)+"L"+formatPoints(q[1:], point))
+    f.write('"/>\n</svg>\n')
+
+def writeGcode(f, polylines, feed=1000, zUp=5, zDown=0, digits=3):
+    # absolute millimetres, lifting to zUp between polylines and
+    # cutting or drawing at zDown along them
+    point = "G1 X%%.%df Y%%.%df\n" % (digits, digits)
+    f.write("G21\nG90\nG0 Z%g\n" % zUp)
+    for p in polylines:
+        if len(p):
+            f.write(("G0 X%%.%df Y%%.%df\n" % (digits, digits)) % tuple(p[0]))
+            f.write("G1 Z%g F%g\n" % (zDown, feed))
+            f.write(formatPoints(p[1:], point))
+            f.write("G0 Z%g\n" % zUp)
+    f.write("G0 X0 Y0\n")
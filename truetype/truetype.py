@@ -12,36 +12,260 @@ import os
 import math
 import ttfparser
 import glyphcurves
+import diskcache
+from glyphstore import GlyphStore, Glyph
+from instrument import Stats
+import render
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+class GlyphCache():
+    # indexable view over a font's glyphs, compiling each one
+    # the first time it is asked for. when maxsize is set, the
+    # least recently used glyphs are evicted beyond that bound.
+    # access is serialized by a lock, since compile reads through
+    # one font's stateful reader, and members of a collection may
+    # share a cache from several threads.
+    def __init__(self, compile, length, maxsize=None):
+        self.compile = compile
+        self.length = length
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        # reentrant: compound glyphs fetch their components
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not (0 <= index < self.length):
+            raise IndexError("glyph index out of range")
+        with self.lock:
+            try:
+                glyph = self.cache.pop(index)
+            except KeyError:
+                glyph = self.compile(index)
+            self.cache[index] = glyph
+            if self.maxsize and len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+            return glyph
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+class CmapIndex():
+    # character map as sorted ranges [starts[i], ends[i]] of codepoints.
+    # a range either maps by a plain delta, or (offsets[i] >= 0) reads
+    # glyphIds[offsets[i] + c - starts[i]], adding delta to nonzero ids.
+    # every supported cmap format compiles down to this.
+    def __init__(self, starts=(), ends=(), deltas=(), offsets=(), glyphIds=()):
+        order = np.argsort(np.asarray(ends, dtype=np.int64), kind='mergesort')
+        self.starts = [int(starts[i]) for i in order]
+        self.ends = [int(ends[i]) for i in order]
+        self.deltas = [int(deltas[i]) for i in order]
+        self.offsets = [int(offsets[i]) for i in order]
+        self.glyphIds = np.asarray(glyphIds, dtype=np.int64)
+
+    def lookup(self, c):
+        i = bisect.bisect_left(self.ends, c)
+        if i == len(self.ends) or c < self.starts[i]:
+            return 0
+        if self.offsets[i] < 0:
+            return (c + self.deltas[i]) % 65536
+        j = self.offsets[i] + c - self.starts[i]
+        if not (0 <= j < len(self.glyphIds)) or self.glyphIds[j] == 0:
+            return 0
+        return int(self.glyphIds[j] + self.deltas[i]) % 65536
+
+    def toArray(self, limit=0x10000):
+        table = np.zeros(limit, dtype=np.int64)
+        for i in range(len(self.starts)):
+            if self.starts[i] >= limit:
+                break
+            c = np.arange(self.starts[i], min(self.ends[i]+1, limit))
+            if self.offsets[i] < 0:
+                table[c] = (c + self.deltas[i]) % 65536
+            else:
+                j = self.offsets[i] + c - self.starts[i]
+                valid = (j >= 0) & (j < len(self.glyphIds))
+                g = np.zeros(len(c), dtype=np.int64)
+                g[valid] = self.glyphIds[j[valid]]
+                table[c] = np.where(g == 0, 0, (g + self.deltas[i]) % 65536)
+        return array('H', table.astype(np.uint16).tostring())
+
+class TrueTypeCollection():
+    # a TrueType collection (.ttc) opened once. its members are loaded
+    # by index as TrueTypeFonts that share the file, and the compiled
+    # glyphs of any glyf and loca tables they have in common.
+    # a single .ttf also works, as a collection of one.
+    def __init__(self, path, mmap=True):
+        self.path = path
+        if mmap:
+            self.raw = ttfparser.mapFile(path)
+        else:
+            self.raw = open(path,'rb').read()
+        self.offsets = ttfparser.collectionOffsets(self.raw)
+        self.glyphSets = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def font(self, index=0, **kwargs):
+        return TrueTypeFont(self.path, index=index, data=self.raw,
+                            glyphSets=self.glyphSets, **kwargs)
+
+    def __getitem__(self, index):
+        if not (0 <= index < len(self)):
+            raise IndexError("font index out of range")
+        return self.font(index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.font(i)
+
+def checkTolerance(tolerance):
+    if tolerance is not None and not tolerance > 0:
+        raise ValueError("tolerance must be positive")
+    return tolerance
 
 class TrueTypeFont():
-    def __init__(self, path, precision = 0, verbose=True):
+    def __init__(self, path, precision = 0, verbose=True, mmap=False,
+                 lazy=False, cacheSize=None, tolerance=None,
+                 cacheDir=None, cacheLimit=256<<20, checksums="lazy",
+                 stats=None, index=0, data=None, glyphSets=None):
+        # index selects a member of a TrueType collection. data and
+        # glyphSets are passed by TrueTypeCollection to share the file
+        # and the glyphs compiled for it between members.
+        self.stats = stats
         self.precision = precision
+        self.tolerance = checkTolerance(tolerance)
+        self.lazy = lazy
         self.verbose = verbose
         self.name = os.path.splitext(os.path.basename(path))[0]
         self.log("reading binary data from "+path+" ...")
-        raw = open(path,'rb').read()
+        t = stats.start("read") if stats else None
+        if data is not None:
+            raw = data
+        elif mmap:
+            raw = ttfparser.mapFile(path)
+        else:
+            raw = open(path,'rb').read()
+        if stats: stats.stop("read", t)
         self.cmapCache = {}
+        self.pointCache = {}
+        self.outlineCache = {}
+        self.advances = None
 
         self.log("parsing .ttf file...")
-        self.ttf = ttfparser.TTFFile(raw)
+        t = stats.start("parse") if stats else None
+        self.ttf = ttfparser.TTFFile(raw, checksums, index)
+        self.index = index
+        if index:
+            self.name += "#%d" % index
+        if stats: stats.stop("parse", t)
 
-        self.log("compiling character map...")
-        self.compileCmap()
+        # with a cache directory, compiled glyphs and the character map
+        # are stored on disk keyed by the font's content and settings
+        self.cacheDir = cacheDir
+        self.cacheLimit = cacheLimit
+        if cacheDir is not None:
+            self.fontHash = diskcache.fontHash(raw)
 
-        self.log("compiling glyphs...")
-        self.compileAllGlyphs()
+        self.cacheSize = cacheSize
+        self.glyphSets = glyphSets
+        self.glyphCache = GlyphCache(self.compileGlyph, self.ttf.length, cacheSize)
+        if not self.loadCache():
+            self.log("compiling character map...")
+            self.compileCmap()
+            self.compileGlyphs()
 
         self.baseline = 0 #self.glyphData[self.chr2idx('x')]['rect'][1]
         self.basewidth = self.glyphData[self.chr2idx('x')]['rect'][2]-\
                  self.glyphData[self.chr2idx('x')]['rect'][0]
         self.log("initialized.")
 
+    def setTolerance(self, tolerance):
+        # switch to adaptive flattening with a maximum chordal error
+        # in font units (None for the fixed precision), dropping any
+        # glyph compiled with the old setting
+        self.tolerance = checkTolerance(tolerance)
+        self.outlineCache.clear()
+        self.glyphCache = GlyphCache(self.compileGlyph, self.ttf.length, self.cacheSize)
+        if not self.loadCache():
+            self.compileGlyphs()
+
+    def compileGlyphs(self):
+        shared = self.glyphSets is not None and self.glyphSets.get(self.glyphSetKey())
+        if shared:
+            self.log("sharing glyphs with another member...")
+            self.glyphCache, self.glyphData = shared
+        elif self.lazy and self.cacheDir is None:
+            self.glyphData = self.glyphCache
+        else:
+            self.log("compiling glyphs...")
+            self.compileAllGlyphs()
+        if self.cacheDir is not None and isinstance(self.glyphData, GlyphStore):
+            self.saveCache()
+        if self.glyphSets is not None:
+            self.glyphSets[self.glyphSetKey()] = self.glyphCache, self.glyphData
+
+    def glyphSetKey(self):
+        # members of a collection pointing at the same glyf and loca
+        # tables have the same glyphs
+        glyf, loca = self.ttf.tables["glyf"], self.ttf.tables["loca"]
+        return (glyf["offset"], loca["offset"], self.ttf.indexToLocFormat,
+                self.ttf.length, self.precision, self.tolerance)
+
+    def saveCache(self):
+        self.log("saving glyphs to cache...")
+        path = self.cachePath()
+        diskcache.saveGlyphs(path, self.glyphData, {
+            "starts": self.cmapIndex.starts,
+            "ends": self.cmapIndex.ends,
+            "deltas": self.cmapIndex.deltas,
+            "offsets": self.cmapIndex.offsets,
+            "glyphIds": self.cmapIndex.glyphIds,
+            "format": [self.cmapFormat or 0],
+        })
+        diskcache.evict(self.cacheDir, self.cacheLimit, keep=path)
+
+    def cachePath(self):
+        return diskcache.cachePath(self.cacheDir, self.fontHash,
+                                   (self.precision, self.tolerance, self.index))
+
+    def loadCache(self):
+        # restore glyphs and character map from the disk cache, if any
+        if self.cacheDir is None:
+            return False
+        cached = diskcache.loadGlyphs(self.cachePath())
+        if cached is None:
+            return False
+        self.log("loaded glyphs from cache.")
+        self.glyphData, cmap = cached
+        self.segments = []
+        self.cmapTable = None
+        self.cmapFormat = int(cmap["format"][0]) or None
+        self.cmapIndex = CmapIndex(cmap["starts"], cmap["ends"], cmap["deltas"],
+                                   cmap["offsets"], cmap["glyphIds"])
+        return True
+
     def log(self,info):
         if (self.verbose):
             print "["+self.name+"]", info
 
     def compileCmap(self):
-        cmap = self.ttf.tables['cmap']
+        stats = self.stats
+        t = stats.start("cmap") if stats else None
+        self.readCmap()
+        if stats: stats.stop("cmap", t)
+
+    def readCmap(self):
+        cmap = self.ttf.table('cmap')
         offset = cmap['offset']
         self.ttf.file.seek(offset)
         version = self.ttf.file.getUint16()
@@ -54,122 +278,321 @@ class TrueTypeFont():
                 "encodingID": self.ttf.file.getUint16(),
                 "offset":     self.ttf.file.getUint32(),
             })
-        segments = []
-        for i in range(len(encodingRecords)):
-            self.ttf.file.seek(offset+encodingRecords[i]['offset'])
-            _format = self.ttf.file.getUint16()
-            if _format != 4 or encodingRecords[i]['platformID'] != 0:
-                continue
-            length = self.ttf.file.getUint16()
-            language = self.ttf.file.getUint16()
-            segCountX2 = self.ttf.file.getUint16()
-            searchRange = self.ttf.file.getUint16()
-            entrySelector = self.ttf.file.getUint16()
-            rangeShift = self.ttf.file.getUint16()
-            segCount = segCountX2 // 2
-            
-            for j in range(segCount):
-                segments.append({})
-            for j in range(segCount):
-                segments[j]['endCode'] = self.ttf.file.getUint16()
-            reservedPad = self.ttf.file.getUint16()
-            for j in range(segCount):
-                segments[j]['startCode'] = self.ttf.file.getUint16()
-            for j in range(segCount):
-                segments[j]['idDelta'] = self.ttf.file.getUint16()
-            for j in range(segCount):
-                segments[j]['idRangeOffset'] = self.ttf.file.getUint16()
-            for i in range(segCount):
-                segments[i]['glyphIndexArray'] = self.ttf.file.tell()
-            break
-        if len(segments) == 0:
-            warnings.warn("Unimplemented: Encoding other than (PlatformID = 0, Format = 4) is not yet supported", Warning)
-        self.segments = segments
+        for rec in encodingRecords:
+            self.ttf.file.seek(offset+rec['offset'])
+            rec['format'] = self.ttf.file.getUint16()
+            rec['rank'] = self.rankCmapSubtable(rec)
+
+        self.segments = []
+        self.cmapIndex = CmapIndex()
+        self.cmapTable = None
+        self.cmapFormat = None
+        candidates = [r for r in encodingRecords if r['rank'] is not None]
+        if len(candidates) == 0:
+            warnings.warn("Unimplemented: no supported cmap subtable (Formats 0, 4, 6, 12)", Warning)
+            return
+        best = min(candidates, key=lambda r: r['rank'])
+        self.cmapFormat = best['format']
+        self.ttf.file.seek(offset+best['offset']+2)
+        if best['format'] == 0:
+            self.cmapIndex = self.readCmap0()
+        elif best['format'] == 4:
+            self.cmapIndex = self.readCmap4(offset+best['offset'])
+        elif best['format'] == 6:
+            self.cmapIndex = self.readCmap6()
+        else:
+            self.cmapIndex = self.readCmap12()
+
+    def rankCmapSubtable(self, rec):
+        # lower is better: full unicode tables first, then BMP
+        # unicode tables, then anything else we can read
+        fmt, pid, eid = rec['format'], rec['platformID'], rec['encodingID']
+        if fmt not in (0, 4, 6, 12):
+            return None
+        isUnicode = pid == 0 or (pid == 3 and eid in (1, 10))
+        if fmt == 12 and isUnicode:
+            return 0
+        if fmt == 4 and isUnicode:
+            return 1
+        if isUnicode:
+            return 2
+        if pid == 3:
+            return 3
+        return 4
+
+    def readCmap0(self):
+        length = self.ttf.file.getUint16()
+        language = self.ttf.file.getUint16()
+        glyphIdArray = self.ttf.file.getArray(np.uint8, 256)
+        return CmapIndex([0], [255], [0], [0], glyphIdArray)
+
+    def readCmap4(self, start):
+        length = self.ttf.file.getUint16()
+        language = self.ttf.file.getUint16()
+        segCountX2 = self.ttf.file.getUint16()
+        searchRange = self.ttf.file.getUint16()
+        entrySelector = self.ttf.file.getUint16()
+        rangeShift = self.ttf.file.getUint16()
+        segCount = segCountX2 // 2
+
+        endCode = self.ttf.file.getArray('>u2', segCount)
+        reservedPad = self.ttf.file.getUint16()
+        startCode = self.ttf.file.getArray('>u2', segCount)
+        idDelta = self.ttf.file.getArray('>u2', segCount)
+        rangeStart = self.ttf.file.tell()
+        # idRangeOffset is a byte offset from its own position, so
+        # idRangeOffset and glyphIndexArray are read as one array
+        words = self.ttf.file.getArray('>u2', max(segCount, (start+length-rangeStart)//2))
+        idRangeOffset = words[:segCount]
+
+        for j in range(segCount):
+            self.segments.append({
+                "endCode": int(endCode[j]),
+                "startCode": int(startCode[j]),
+                "idDelta": int(idDelta[j]),
+                "idRangeOffset": int(idRangeOffset[j]),
+                "glyphIndexArray": rangeStart+j*2+int(idRangeOffset[j]),
+            })
+        arrayOffset = np.where(idRangeOffset == 0, -1,
+                               np.arange(segCount)+idRangeOffset//2)
+        return CmapIndex(startCode, endCode, idDelta, arrayOffset, words)
+
+    def readCmap6(self):
+        length = self.ttf.file.getUint16()
+        language = self.ttf.file.getUint16()
+        firstCode = self.ttf.file.getUint16()
+        entryCount = self.ttf.file.getUint16()
+        glyphIdArray = self.ttf.file.getArray('>u2', entryCount)
+        return CmapIndex([firstCode], [firstCode+entryCount-1], [0], [0], glyphIdArray)
+
+    def readCmap12(self):
+        reserved = self.ttf.file.getUint16()
+        length = self.ttf.file.getUint32()
+        language = self.ttf.file.getUint32()
+        numGroups = self.ttf.file.getUint32()
+        groups = self.ttf.file.getArray('>u4', numGroups*3).reshape(-1,3).astype(np.int64)
+        startCharCode, endCharCode, startGlyphID = groups[:,0], groups[:,1], groups[:,2]
+        return CmapIndex(startCharCode, endCharCode, startGlyphID-startCharCode,
+                         -np.ones(numGroups, dtype=int))
+
+    def materializeCmap(self, limit=0x10000):
+        # expand the cmap into a flat codepoint -> glyph index table
+        # for bulk conversion of whole unicode blocks
+        self.cmapTable = self.cmapIndex.toArray(limit)
+        return self.cmapTable
 
     def chr2idx(self,char):
         try:
             return self.cmapCache[char]
         except KeyError:
             pass
-        c = ord(char)
-        seg = None
-        result = 0
-        for s in self.segments:
-            if s['startCode'] <= c <= s['endCode']:
-                seg = s
-                break
-        if seg is not None:
-            if seg['idRangeOffset'] == 0:
-                result = (seg['idDelta']+c) % 65536
-            else:
-                glyphIndexAddress = (c-seg['startCode'])
-                self.ttf.file.seek(seg['glyphIndexArray'])
-                for i in range(glyphIndexAddress):
-                    self.ttf.file.getUint16()
-                result = self.ttf.file.getUint16()
+        c = char if isinstance(char, (int, long)) else ord(char)
+        if self.cmapTable is not None and c < len(self.cmapTable):
+            result = self.cmapTable[c]
+        else:
+            result = self.cmapIndex.lookup(c)
 
         self.cmapCache[char] = result
         return result
 
+    def loadMetrics(self):
+        # advance widths and pair kerning, read on first layout
+        if self.advances is None:
+            self.advances, self.bearings = self.ttf.readHmtxTable()
+            self.kernKeys, self.kernValues = self.ttf.readKernTable()
+            self.lineHeight = self.ttf.ascender-self.ttf.descender+self.ttf.lineGap
+
+    def glyphIndices(self, text):
+        # glyph index of every character of text, through the flat
+        # cmap table for the basic multilingual plane
+        if self.cmapTable is None:
+            self.materializeCmap()
+        codes = np.frombuffer(unicode(text).encode('utf-32-le'), '<u4')
+        table = np.frombuffer(self.cmapTable, np.uint16)
+        bmp = codes < len(table)
+        glyphs = np.zeros(len(codes), dtype=np.int32)
+        glyphs[bmp] = table[codes[bmp]]
+        for i in np.nonzero(~bmp)[0]:
+            glyphs[i] = self.chr2idx(int(codes[i]))
+        return glyphs
+
+    def layout(self, lines, lineHeight=None, tracking=0, align="left"):
+        # place the characters of lines (a string, or a list of strings
+        # one per line) in one pass, using advance widths and pair
+        # kerning. returns glyph indices and the x, y of each glyph's
+        # origin in font units; line i is at y = -i*lineHeight.
+        # tracking is extra space after every character.
+        self.loadMetrics()
+        if isinstance(lines, basestring):
+            lines = [lines]
+        if lineHeight is None:
+            lineHeight = self.lineHeight
+        lengths = np.array([len(unicode(l).encode('utf-32-le'))//4 for l in lines], dtype=np.int64)
+        glyphs = self.glyphIndices(u"".join(unicode(l) for l in lines))
+        lineIds = np.repeat(np.arange(len(lines)), lengths)
+
+        adv = self.advances[glyphs]+tracking
+        if len(self.kernKeys) and len(glyphs) > 1:
+            pairs = (glyphs[:-1].astype(np.uint32) << 16) | glyphs[1:].astype(np.uint32)
+            k = np.searchsorted(self.kernKeys, pairs).clip(max=len(self.kernKeys)-1)
+            hit = (self.kernKeys[k] == pairs) & (lineIds[:-1] == lineIds[1:])
+            adv[:-1] += np.where(hit, self.kernValues[k], 0)
+
+        # running sum of advances, restarted at every line
+        end = np.cumsum(adv)
+        start = np.concatenate([[0], end])
+        firsts = np.cumsum(lengths)-lengths
+        x = start[:-1]-np.repeat(start[firsts], lengths)
+        if align != "left":
+            widths = start[firsts+lengths]-start[firsts]
+            shift = widths if align == "right" else widths/2.0
+            x = x-np.repeat(shift, lengths)
+        y = -lineIds*lineHeight
+        return glyphs, x, y
+
+    def glyphOutline(self, index):
+        # the glyph's closed contours as one array, and their lengths
+        try:
+            return self.outlineCache[index]
+        except KeyError:
+            pass
+        glyph = self.glyphData[index]
+        contours = glyph.contours if isinstance(glyph, Glyph) else glyph['poly']
+        closed = [np.concatenate([c, c[:1]]) for c in map(np.asarray, contours) if len(c)]
+        outline = (np.concatenate(closed).astype(float) if closed else np.zeros((0,2)),
+                   [len(c) for c in closed])
+        self.outlineCache[index] = outline
+        return outline
+
+    def render(self, lines, size=None, origin=(0,0), **kwargs):
+        # lay out lines (see layout) and return the glyph outlines as
+        # closed (M,2) polylines, scaled so that an em is size units
+        # (font units if None) and moved so the first baseline starts
+        # at origin. y points up.
+        glyphs, x, y = self.layout(lines, **kwargs)
+        outlines = [self.glyphOutline(g) for g in glyphs.tolist()]
+        counts = [len(o[0]) for o in outlines]
+        if sum(counts) == 0:
+            return []
+        pts = np.concatenate([o[0] for o in outlines])
+        pts += np.repeat(np.column_stack([x, y]), counts, axis=0)
+        scale = 1.0 if size is None else float(size)/self.ttf.unitsPerEm
+        pts = pts*scale+origin
+        lengths = [n for o in outlines for n in o[1]]
+        return np.split(pts, np.cumsum(lengths)[:-1])
+
+    def writeSVG(self, f, lines, size=None, margin=0, stroke="black", strokeWidth=1, **kwargs):
+        render.writeSVG(f, self.render(lines, size, **kwargs), margin, stroke, strokeWidth)
+
+    def writeGcode(self, f, lines, size=10, origin=(0,0), feed=1000, zUp=5, zDown=0, **kwargs):
+        # size is the em size in millimetres
+        render.writeGcode(f, self.render(lines, size, origin, **kwargs), feed, zUp, zDown)
+
     def compileGlyph (self, index):
-        glyph = self.ttf.readGlyph(index);
-        bbox = glyph['xMin'], glyph['yMin'], glyph['xMax'], glyph['yMax']
-        if (glyph == None):
-            warnings.warn("No glyph!", Warning)
-            return {"rect":(0,0,1,1), "poly":[]}
-
-        if (glyph["type"] == "simple" ):
-            points =  glyph["points"]
-
-            ptlist = []
-            for i in range(0,len(glyph["contourEnds"])):
-                e0 = (glyph["contourEnds"][i-1]+1) if i != 0 else 0
-                e1 = glyph["contourEnds"][i]+1
-                ptlist.append(points[e0:e1])
-
-            polylines = []
-            for i in range(len(ptlist)):
-                if self.precision == 0:
-                    polylines.append([])
-                    for j in range(len(ptlist[i])):
-                        p = ptlist[i][j]
-                        polylines[-1].append([p['x'],p['y']])
-                else:
-                    
-                    cc = glyphcurves.construct_curve(ptlist[i],self.precision)
-                    polylines.append(cc)
-                
-        else:
-            components = glyph["components"]
-            polylines = []
-            for c in components:
-                subglyf = self.compileGlyph(c['glyphIndex'])['poly']
-                xof,yof = 0,0
-                xscale, yscale = 1,1
-                if c['flags']['ARGS_ARE_XY_VALUES']:
-                    xof, yof = c['matrix']['e'], c['matrix']['f']
-                else:
-                    warnings.warn("Unimplemented: Compound glyphs point matching", Warning)
-                if c['flags']['WE_HAVE_A_SCALE'] or c['flags']['WE_HAVE_AN_X_AND_Y_SCALE']:
-                    xscale , yscale = c['matrix']['a'], c['matrix']['d']
-                if c['flags']['WE_HAVE_A_TWO_BY_TWO']:
-                    warnings.warn("Unimplemented: Compound glyphs linear transformation", Warning)
+        stats = self.stats
+        t = stats.start("glyph") if stats else None
+        # the timer is stopped on every exit, keeping a profiled
+        # stage balanced
+        kind = "missing"
+        try:
+            glyph = self.ttf.readGlyph(index);
+            if (glyph == None):
+                warnings.warn("No glyph!", Warning)
+                return {"rect":(0,0,1,1), "poly":[]}
+            bbox = glyph['xMin'], glyph['yMin'], glyph['xMax'], glyph['yMax']
+            kind = glyph["type"] if glyph["numberOfContours"] else "empty"
+
+            if (glyph["type"] == "simple" ):
+                coords = glyph["coords"]
+                onCurve = glyph["onCurve"]
+                contourEnds = glyph["contourEnds"].tolist()
 
-                for i in range(len(subglyf)):
+                if self.precision == 0 and self.tolerance is None:
+                    polylines = []
+                    for i in range(0,len(contourEnds)):
+                        e0 = (contourEnds[i-1]+1) if i != 0 else 0
+                        e1 = contourEnds[i]+1
+                        polylines.append(coords[e0:e1].tolist())
+                else:
+                    tf = stats.start("flatten") if stats else None
                     try:
-                        subglyf[i] = [[xy[0]*xscale+xof, xy[1]*yscale+yof] for xy in subglyf[i]]
-                    except:
-                        self.log("subglyph failure:")
-                        self.log(subglyf)
-                        self.log(len(subglyf))
-                        self.log(subglyf[i])
-                polylines += subglyf
+                        polylines = [cc.tolist() for cc in glyphcurves.flatten_glyph(
+                            coords, onCurve, contourEnds, self.precision,
+                            tolerance=self.tolerance)]
+                    finally:
+                        if stats: stats.stop("flatten", tf, index)
+
+            else:
+                # components come compiled from the glyph cache, so a base
+                # letter or accent shared by many glyphs is built only once
+                polylines = []
+                for c, (M, offset) in zip(glyph["components"], self.componentTransforms(glyph)):
+                    subglyf = self.glyphCache[c['glyphIndex']]['poly']
+                    lengths = [len(p) for p in subglyf]
+                    if sum(lengths) == 0:
+                        polylines += [[] for p in subglyf]
+                        continue
+                    pts = np.concatenate([np.asarray(p).reshape(-1,2) for p in subglyf])
+                    pts = (pts.dot(M.T)+offset).tolist()
+                    ends = np.cumsum(lengths).tolist()
+                    polylines += [pts[e-n:e] for n, e in zip(lengths, ends)]
+
+            return {"rect":bbox, "poly":polylines}
+        finally:
+            if stats: stats.stop("glyph", t, index, "glyph."+kind)
 
-        return {"rect":bbox, "poly":polylines}
+    def componentTransforms(self, glyph):
+        # (M, offset) for each component of a compound glyph, mapping
+        # its points p to M.p + offset. offsets given by point matching
+        # line up a point of the glyph built so far (destPointIndex)
+        # with a point of the component (srcPointIndex).
+        components = glyph["components"]
+        matching = not all(c['flags']['ARGS_ARE_XY_VALUES'] for c in components)
+        placed = []
+        transforms = []
+        for c in components:
+            m = c['matrix']
+            M = np.array([[m['a'], m['c']], [m['b'], m['d']]])
+            offset = np.array([m['e'], m['f']])
+            if matching:
+                pts = self.glyphPoints(c['glyphIndex']).dot(M.T)
+            if not c['flags']['ARGS_ARE_XY_VALUES']:
+                parent = np.concatenate(placed) if placed else np.zeros((0,2), dtype=int)
+                dest, src = c['destPointIndex'], c['srcPointIndex']
+                if dest < len(parent) and src < len(pts):
+                    offset = parent[dest]-pts[src]
+                else:
+                    warnings.warn("Compound glyph point matching out of range", Warning)
+            if matching:
+                placed.append(pts+offset)
+            transforms.append((M, offset))
+        return transforms
+
+    def glyphPoints(self, index):
+        # unflattened outline points of a glyph, as numbered by
+        # compound glyph point matching
+        if index in self.pointCache:
+            return self.pointCache[index]
+        glyph = self.ttf.readGlyph(index)
+        if glyph is None:
+            points = np.zeros((0,2), dtype=int)
+        elif glyph["type"] == "simple":
+            points = glyph["coords"].astype(int)
+        else:
+            points = [self.glyphPoints(c['glyphIndex']).dot(M.T)+offset for c, (M, offset)
+                      in zip(glyph["components"], self.componentTransforms(glyph))]
+            points = np.concatenate(points) if points else np.zeros((0,2), dtype=int)
+        self.pointCache[index] = points
+        return points
 
     def compileAllGlyphs(self):
-        self.glyphData = []
-        for i in xrange(self.ttf.length):
-            self.glyphData.append(self.compileGlyph(i))
+        # each glyph is packed into the store as soon as it is compiled;
+        # only glyphs used as components of compound glyphs stay in the
+        # cache until the store is built
+        cache = self.glyphCache.cache
+        self.glyphData = GlyphStore.fromGlyphs(
+            cache[i] if i in cache else self.compileGlyph(i)
+            for i in xrange(self.ttf.length))
+        cache.clear()
 
 
@@ -4,15 +4,53 @@
 
 import numpy as np
 import struct
+import mmap
+
+
+def mapFile(path):
+    # read-only memory map of a font file, pages are
+    # loaded by the OS only when a table is touched
+    f = open(path,'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def collectionOffsets(arrayBuffer):
+    # offsets of the fonts in a TrueType collection (.ttc),
+    # or [0] for a single font
+    file = BinaryReader(arrayBuffer);
+    if (file.getString(4) != 'ttcf'):
+        return [0];
+    file.getUint32(); # version
+    numFonts = file.getUint32();
+    return [file.getUint32() for i in xrange(numFonts)];
 
 
 class BinaryReader():
+    # precompiled big-endian field decoders
+    UINT8  = struct.Struct('>B')
+    UINT16 = struct.Struct('>H')
+    INT16  = struct.Struct('>h')
+    UINT32 = struct.Struct('>I')
+    INT32  = struct.Struct('>i')
+
     def __init__(this,arrayBuffer):
+        # arrayBuffer can be a str, a memoryview or an mmap;
+        # fields are decoded in place, no copy of the data is made.
         this.pos = 0
-        this.data = [struct.unpack('B', x)[0] for x in arrayBuffer]
+        this.data = arrayBuffer
+        this.length = len(arrayBuffer)
+        # numpy can't take a memoryview as a buffer here, but
+        # can wrap it as a uint8 array without copying
+        if isinstance(arrayBuffer, memoryview):
+            this.buffer = np.asarray(arrayBuffer)
+        else:
+            this.buffer = arrayBuffer
 
     def seek(this, pos):
-        assert(pos >=0 and pos <= len(this.data))
+        assert(pos >=0 and pos <= this.length)
         oldPos = this.pos
         this.pos = pos
         return oldPos
@@ -20,43 +58,49 @@ class BinaryReader():
     def tell(this):
         return this.pos;
 
+    def read(this, fmt):
+        result = fmt.unpack_from(this.data, this.pos)[0]
+        this.pos += fmt.size
+        return result
+
     def getUint8(this):
-        assert(this.pos < len(this.data));
-        this.pos += 1
-        return this.data[this.pos-1];
+        assert(this.pos < this.length);
+        return this.read(this.UINT8);
 
     def getUint16(this):
-        return ((this.getUint8() << 8) | this.getUint8()) >> 0;
+        return this.read(this.UINT16);
 
     def getUint32(this):
-       return this.getInt32() >> 0;
+       return this.read(this.UINT32);
 
     def getInt16(this):
-        result = this.getUint16();
-        if (result & 0x8000):
-            result -= (1 << 16);
-        return result;
+        return this.read(this.INT16);
 
     def getInt32(this):
-        return ((this.getUint8() << 24) | 
-                (this.getUint8() << 16) |
-                (this.getUint8() <<  8) |
-                (this.getUint8()      ));
+        return this.read(this.INT32);
 
     def getFword(this):
         return this.getInt16();
 
     def get2Dot14(this):
-        return this.getInt16() / (1 << 14);
+        return this.getInt16() / float(1 << 14);
     
 
     def getFixed(this):
-        return this.getInt32() / (1 << 16);
+        return this.getInt32() / float(1 << 16);
+
+    def getArray(this, dtype, count):
+        # numpy view over the next count fields of dtype
+        dtype = np.dtype(dtype)
+        result = np.frombuffer(this.buffer, dtype, count, this.pos)
+        this.pos += dtype.itemsize * count
+        return result
 
     def getString(this,length):
-        result = "";
-        for i in xrange(length):
-            result += chr(this.getUint8());
+        result = this.data[this.pos:this.pos+length];
+        if isinstance(result, memoryview):
+            result = result.tobytes()
+        this.pos += length
         return result
 
     def getDate(this):
@@ -65,8 +109,18 @@ class BinaryReader():
 
 
 class TTFFile():
-    def __init__(this, arrayBuffer):
+    # checksums: "eager" verifies every table when opening the file,
+    # "lazy" verifies a table the first time it is read, "off" trusts
+    # the file and skips verification.
+    # index selects a member when the file is a TrueType collection.
+    def __init__(this, arrayBuffer, checksums="lazy", index=0):
+        assert(checksums in ("eager", "lazy", "off"));
+        this.checksums = checksums;
         this.file = BinaryReader(arrayBuffer);
+        this.offsets = collectionOffsets(arrayBuffer);
+        assert(0 <= index < len(this.offsets));
+        this.index = index;
+        this.file.seek(this.offsets[index]);
         this.tables = this.readOffsetTables(this.file);
         this.readHeadTable(this.file);
         this.length = this.glyphCount();
@@ -85,28 +139,39 @@ class TTFFile():
             tables[tag] = {
                 "checksum": file.getUint32(),
                 "offset": file.getUint32(),
-                "length": file.getUint32()
+                "length": file.getUint32(),
+                # head holds the whole-font checksum adjustment,
+                # so its own checksum is not checked
+                "verified": tag == 'head',
             };
 
-            if (tag != 'head'):
+        if (this.checksums == "eager"):
+            for tag in tables:
+                this.verifyTable(tables[tag]);
+        return tables
 
-                assert(this.calculateTableChecksum(file, tables[tag]["offset"],
-                            tables[tag]["length"]) == tables[tag]["checksum"]);
+    def table(this, tag):
+        table = this.tables[tag];
+        if (not table["verified"] and this.checksums == "lazy"):
+            this.verifyTable(table);
+        return table
 
-            
-        return tables
+    def verifyTable(this, table):
+        if (not table["verified"]):
+            assert(this.calculateTableChecksum(this.file, table["offset"],
+                        table["length"]) == table["checksum"]);
+            table["verified"] = True;
 
     def calculateTableChecksum(this, file, offset, length):
-
+        # sum of the table as big-endian uint32s, zero padded
         old = file.seek(offset);
-        _sum = 0;
-        nlongs = ((length + 3) / 4) | 0;
-        while ( nlongs > 0 ):
-            nlongs -= 1
-            _sum = (_sum + file.getUint32() & 0xffffffff) >> 0;
+        _sum = int(file.getArray('>u4', length // 4).sum(dtype=np.uint64));
+        tail = file.getArray(np.uint8, length % 4);
+        for i in xrange(len(tail)):
+            _sum += int(tail[i]) << (24 - 8 * i);
 
         file.seek(old);
-        return _sum;
+        return _sum & 0xffffffff;
 
     def readHeadTable(this,file):
         assert("head" in this.tables);
@@ -131,9 +196,69 @@ class TTFFile():
         this.indexToLocFormat = file.getInt16();
         this.glyphDataFormat = file.getInt16();
 
+    def readHheaTable(this):
+        assert("hhea" in this.tables);
+        file = this.file;
+        old = file.seek(this.table("hhea")["offset"] + 4);
+        this.ascender = file.getFword();
+        this.descender = file.getFword();
+        this.lineGap = file.getFword();
+        file.seek(this.table("hhea")["offset"] + 34);
+        this.numberOfHMetrics = file.getUint16();
+        file.seek(old);
+
+    def readHmtxTable(this):
+        # advance width and left side bearing of every glyph. fonts
+        # may list fewer advances than glyphs, the last one repeats.
+        this.readHheaTable();
+        file = this.file;
+        old = file.seek(this.table("hmtx")["offset"]);
+        n = this.numberOfHMetrics;
+        metrics = file.getArray('>i2', n * 2).reshape(-1, 2);
+        lsb = file.getArray('>i2', max(this.length - n, 0));
+        file.seek(old);
+
+        advances = np.empty(this.length, dtype=np.int32);
+        advances[:n] = metrics[:, 0].view('>u2')[:this.length];
+        advances[n:] = advances[n - 1];
+        bearings = np.concatenate([metrics[:, 1], lsb])[:this.length].astype(np.int32);
+        return advances, bearings;
+
+    def readKernTable(this):
+        # horizontal pair kerning from the format 0 subtables of the
+        # (microsoft) kern table, as sorted keys left << 16 | right and
+        # their adjustments. kerning in GPOS is not read.
+        keys, values = [], [];
+        if ("kern" in this.tables):
+            file = this.file;
+            old = file.seek(this.table("kern")["offset"]);
+            version = file.getUint16();
+            nTables = file.getUint16();
+            for i in xrange(nTables if version == 0 else 0):
+                start = file.tell();
+                file.getUint16(); # subtable version
+                length = file.getUint16();
+                coverage = file.getUint16();
+                # horizontal, not minimum values or cross-stream
+                if (coverage >> 8 == 0 and coverage & 0x7 == 1):
+                    nPairs = file.getUint16();
+                    file.seek(file.tell() + 6);
+                    pairs = file.getArray('>u2', nPairs * 3).reshape(-1, 3);
+                    keys.append((pairs[:, 0].astype(np.uint32) << 16) | pairs[:, 1]);
+                    values.append(pairs[:, 2].view('>i2').astype(np.int32));
+                file.seek(start + length);
+            file.seek(old);
+        if (not keys):
+            return np.zeros(0, np.uint32), np.zeros(0, np.int32);
+        keys = np.concatenate(keys);
+        values = np.concatenate(values);
+        # later subtables add to earlier ones
+        keys, inverse = np.unique(keys, return_inverse=True);
+        return keys, np.bincount(inverse, values).astype(np.int32);
+
     def glyphCount(this):
         assert("maxp" in this.tables);
-        old = this.file.seek(this.tables["maxp"]["offset"] + 4);
+        old = this.file.seek(this.table("maxp")["offset"] + 4);
         count = this.file.getUint16();
         this.file.seek(old);
         return count;
@@ -141,7 +266,7 @@ class TTFFile():
 
     def getGlyphOffset(this,index):
         assert("loca" in this.tables);
-        table = this.tables["loca"];
+        table = this.table("loca");
         file = this.file;
         offset, old = 0, 0
 
@@ -153,18 +278,31 @@ class TTFFile():
             offset = file.getUint16() * 2;
 
         file.seek(old);
-        return offset + this.tables["glyf"]["offset"];
+        return offset + this.table("glyf")["offset"];
 
 
     def readGlyph(this, index):
         offset = this.getGlyphOffset(index);
         file = this.file;
 
-        if (offset >= this.tables["glyf"]["offset"] + this.tables["glyf"]["length"]):
+        glyf = this.table("glyf");
+
+        # glyphs without outlines (e.g. space) take no room in glyf
+        if (this.getGlyphOffset(index + 1) == offset):
+            return {
+                "numberOfContours": 0,
+                "xMin": 0, "yMin": 0, "xMax": 0, "yMax": 0,
+                "type": "simple",
+                "contourEnds": np.zeros(0, np.int32),
+                "coords": np.zeros((0,2), np.int16),
+                "onCurve": np.zeros(0, bool),
+            };
+
+        if (offset >= glyf["offset"] + glyf["length"]):
             return None
 
-        assert(offset >= this.tables["glyf"]["offset"]);
-        assert(offset < this.tables["glyf"]["offset"] + this.tables["glyf"]["length"]);
+        assert(offset >= glyf["offset"]);
+        assert(offset < glyf["offset"] + glyf["length"]);
 
         file.seek(offset);
 
@@ -195,11 +333,9 @@ class TTFFile():
         Y_DELTA         = 32
 
         glyph["type"] = "simple";
-        glyph["contourEnds"] = [];
-        points = glyph["points"] = [];
-
-        for i in xrange(0, glyph["numberOfContours"]):
-            glyph["contourEnds"].append(file.getUint16());
+        glyph["contourEnds"] = file.getArray('>u2', glyph["numberOfContours"]).astype(np.int32);
+        glyph["coords"] = np.zeros((0,2), np.int16);
+        glyph["onCurve"] = np.zeros(0, bool);
 
         # skip over intructions
         file.seek(file.getUint16() + file.tell());
@@ -207,49 +343,47 @@ class TTFFile():
         if (glyph["numberOfContours"] == 0):
             return;
 
-        numPoints = max(glyph["contourEnds"]) + 1;
+        numPoints = int(glyph["contourEnds"].max()) + 1;
 
-        flags = [];
+        # only runs of flags are walked in python,
+        # repeats are expanded in one go
+        runFlags = [];
+        runCounts = [];
 
         i = 0
         while (i < numPoints):
             flag = file.getUint8();
-            flags.append(flag);
-            points.append({
-                "onCurve": (flag & ON_CURVE) > 0
-            });
-
+            count = 1
             if ( flag & REPEAT ):
                 repeatCount = file.getUint8();
                 assert(repeatCount > 0);
-                i += repeatCount;
-                while( repeatCount > 0):
-                    repeatCount -= 1
-                    flags.append(flag);
-                    points.append({
-                        "onCurve": (flag & ON_CURVE) > 0
-                    })
-            i += 1
-
-        def readCoords(name, byteFlag, deltaFlag, min, max):
-            value = 0;
-
-            for i in xrange(numPoints):
-                flag = flags[i];
-                if ( flag & byteFlag ):
-                    if ( flag & deltaFlag ):
-                        value += file.getUint8();
-                    else:
-                        value -= file.getUint8();
-                elif ( (~flag) & deltaFlag ):
-                    value += file.getInt16()
-                else:
-                    pass
-                    # value is unchanged.
-                points[i][name] = value;
-            
-        readCoords("x", X_IS_BYTE, X_DELTA, glyph["xMin"], glyph["xMax"]);
-        readCoords("y", Y_IS_BYTE, Y_DELTA, glyph["yMin"], glyph["yMax"]);
+                count += repeatCount
+            runFlags.append(flag);
+            runCounts.append(count);
+            i += count
+
+        flags = np.repeat(np.array(runFlags, np.uint8), runCounts)[:numPoints];
+
+        def readCoords(byteFlag, deltaFlag):
+            isByte = (flags & byteFlag) > 0
+            isDelta = (flags & deltaFlag) > 0
+            isWord = ~isByte & ~isDelta
+            # 1 byte, 2 bytes or nothing (value is unchanged) per point
+            size = np.where(isByte, 1, np.where(isWord, 2, 0))
+            start = np.cumsum(size) - size
+            data = file.getArray(np.uint8, int(size.sum())).astype(np.int32)
+
+            deltas = np.zeros(numPoints, np.int32)
+            byte = data[start[isByte]]
+            deltas[isByte] = np.where(isDelta[isByte], byte, -byte)
+            word = (data[start[isWord]] << 8) | data[start[isWord]+1]
+            deltas[isWord] = word - ((word & 0x8000) << 1)
+            return np.cumsum(deltas)
+
+        x = readCoords(X_IS_BYTE, X_DELTA);
+        y = readCoords(Y_IS_BYTE, Y_DELTA);
+        glyph["coords"] = np.column_stack((x, y)).astype(np.int16);
+        glyph["onCurve"] = (flags & ON_CURVE) > 0;
 
     def readCompoundGlyph(this, file, glyph):
         ARG_1_AND_2_ARE_WORDS    = 1
@@ -285,19 +419,27 @@ class TTFFile():
                 }
             };
 
+            # offsets are signed, point numbers unsigned
             if ( flags & ARG_1_AND_2_ARE_WORDS ):
-                arg1 = file.getInt16();
-                arg2 = file.getInt16();
+                if ( flags & ARGS_ARE_XY_VALUES ):
+                    arg1 = file.getInt16();
+                    arg2 = file.getInt16();
+                else:
+                    arg1 = file.getUint16();
+                    arg2 = file.getUint16();
             else:
                 arg1 = file.getUint8();
                 arg2 = file.getUint8();
+                if ( flags & ARGS_ARE_XY_VALUES ):
+                    arg1 -= (arg1 & 0x80) << 1;
+                    arg2 -= (arg2 & 0x80) << 1;
 
             if ( flags & ARGS_ARE_XY_VALUES ):
                 component["matrix"]["e"] = arg1;
                 component["matrix"]["f"] = arg2;
             else:
-                component.destPointIndex = arg1;
-                component.srcPointIndex = arg2;
+                component["destPointIndex"] = arg1;
+                component["srcPointIndex"] = arg2;
 
             if ( flags & WE_HAVE_A_SCALE ):
                 component["matrix"]['a'] = file.get2Dot14();
@@ -6,63 +6,464 @@
 # - http://paulbourke.net/dataformats/hershey/
 
 import sys
+import glob
+import time
+import argparse
+import traceback
+import threading
+import multiprocessing
+from collections import OrderedDict
 from truetype.truetype import *
 
-def tohershey(text,font_path="ttf/ubuntu.ttf",kern=0,verbose=True):
-    ttf = TrueTypeFont(font_path,verbose=verbose)
-    outer = ttf.ttf.xMin, ttf.ttf.yMin, ttf.ttf.xMax, ttf.ttf.yMax
+def hersheyscale(head,kern=0,baseline=0):
+    # font units -> hershey units, fitting the font's bounding box
+    outer = head.xMin, head.yMin, head.xMax, head.yMax
     cmax = (36-kern)*2
     umax = max( abs(outer[2]-outer[0]),
                 abs(outer[3]-outer[1]),
-                abs(outer[3]-ttf.baseline),
-                abs(outer[1]-ttf.baseline)
+                abs(outer[3]-baseline),
+                abs(outer[1]-baseline)
             )
-    scale = float(cmax)/umax
-    result = ""
+    return float(cmax)/umax
 
-    x_xmin,_,x_xmax,_ = ttf.glyphData[ttf.chr2idx('x')]['rect']
-    x_xcent = (x_xmin+x_xmax)/2.0
+# hershey coordinates are single characters offset from 'R'
+HERSHEY_MAX = 49
+PENUP = np.array([[np.nan,np.nan]])
 
-    for i in range(len(text)):
-        ch = text[i]
-        index = ttf.chr2idx(ch)
+def hersheyencode(contours,xcent,baseline,scale,simplify=None,optimize=False,travel=None):
+    # encode a glyph's contours as hershey vertex pairs in one pass,
+    # closing each contour and separating them with pen-up " R".
+    # with simplify (in hershey units), repeated grid points are dropped
+    # and each contour is simplified with Ramer-Douglas-Peucker.
+    # with optimize, contours are reordered and their start points moved
+    # to shorten the pen-up travel; the travel before and after is added
+    # to travel[0] and travel[1] if given.
+    # returns the encoded string and how many coordinates fell outside
+    # the hershey range and were clamped.
+    rows = []
+    for c in contours:
+        if len(c) == 0:
+            continue
+        c = np.asarray(c,dtype=float)
+        if rows:
+            rows.append(PENUP)
+        rows += [c,c[:1]]
+    if not rows:
+        return "", 0
+    pts = np.concatenate(rows)
+    penup = np.isnan(pts[:,0])
+    pts[penup] = 0
+
+    v = np.empty_like(pts)
+    v[:,0] = (pts[:,0]-xcent)*scale
+    v[:,1] = -(pts[:,1]-baseline)*scale
+    # round halves away from zero, as python 2's round() does
+    r = np.round(v)
+    half = np.abs(v-np.trunc(v)) == 0.5
+    r[half] = (np.trunc(v)+np.sign(v))[half]
+
+    if simplify is not None or optimize:
+        cuts = np.nonzero(penup)[0]
+        pieces = [r[s:e] for s,e in zip(np.concatenate([[0],cuts+1]),np.concatenate([cuts,[len(r)]]))]
+        if simplify is not None:
+            pieces = [glyphcurves.simplify_polyline(c,simplify) for c in pieces]
+        if optimize:
+            pieces, before, after = glyphcurves.order_contours(pieces)
+            if travel is not None:
+                travel[0] += before
+                travel[1] += after
+        rows, flags = [], []
+        for c in pieces:
+            if rows:
+                rows.append(np.zeros((1,2)))
+                flags.append([True])
+            rows.append(c)
+            flags.append(np.zeros(len(c),dtype=bool))
+        r = np.concatenate(rows)
+        penup = np.concatenate(flags)
+
+    clamped = int(np.count_nonzero(np.abs(r[~penup]) > HERSHEY_MAX))
+    codes = np.clip(r,-HERSHEY_MAX,HERSHEY_MAX)+ord('R')
+    codes[penup] = (ord(' '),ord('R'))
+    return codes.astype(np.uint8).tobytes(), clamped
+
+class HersheyConverter():
+    # a font loaded once for converting many strings. the scale and
+    # reference metrics are computed up front, and encoded glyphs are
+    # cached across calls. safe to share between threads: cached
+    # glyphs are read without locking, new ones are compiled under
+    # a lock since the font reader is stateful.
+    # cache_size bounds the glyphs kept compiled (least recently used
+    # dropped first) and encoded (oldest dropped first, so that hits
+    # stay lock-free), so that streaming a large font runs in bounded
+    # memory. None keeps them all.
+    # index selects a member of a .ttc collection; pass the opened
+    # TrueTypeCollection as collection to share its glyphs between
+    # the converters of several members.
+    def __init__(self,font_path="ttf/ubuntu.ttf",kern=0,verbose=True,tolerance=None,
+                 cache_dir=None,stats=None,simplify=None,optimize=False,index=0,
+                 collection=None,cache_size=4096):
+        if tolerance is not None:
+            # tolerance is given in output (hershey) units
+            head = ttfparser.TTFFile(ttfparser.mapFile(font_path),index=index)
+            tolerance = tolerance/hersheyscale(head,kern)
+        kwargs = dict(verbose=verbose,lazy=cache_dir is None,tolerance=tolerance,
+                      cacheDir=cache_dir,stats=stats,cacheSize=cache_size)
+        if collection is None:
+            self.ttf = TrueTypeFont(font_path,index=index,**kwargs)
+        else:
+            self.ttf = collection.font(index,**kwargs)
+        self.kern = kern
+        self.stats = stats
+        self.simplify = simplify
+        self.optimize = optimize
+        self.scale = hersheyscale(self.ttf.ttf,kern,self.ttf.baseline)
 
-        polylines, (xmin,ymin,xmax,ymax) = ttf.glyphData[index]['poly'], \
-                                           ttf.glyphData[index]['rect']
-        width = xmax - xmin
-        height = ymax - ymin
+        x_xmin,_,x_xmax,_ = self.ttf.glyphData[self.ttf.chr2idx('x')]['rect']
+        x_xcent = (x_xmin+x_xmax)/2.0
+        self.space = chr(int((x_xmin-x_xcent)/2.0*self.scale)+ord('R'))\
+                    +chr(int((x_xmax-x_xcent)/2.0*self.scale)+ord('R'))
 
-        xcent = xmin + width/2.0
-        ycent = ymin + height/2.0
+        # glyph index -> (encoded body, clamped coordinates); codepoints
+        # mapping to the same glyph share one entry
+        self.bodies = OrderedDict()
+        self.cacheSize = cache_size
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+        self.lastLatency = 0.0
+        # vertices of the encoded glyphs before and after simplification
+        self.vertices = 0
+        self.simplified = 0
+        # pen-up travel within glyphs before and after optimizing
+        self.travel = [0.0,0.0]
 
+    def body(self,ch):
         if ch == " ":
-            result += str(ord(ch)).rjust(5)+str(2).rjust(3)
-            result += chr(int((x_xmin-x_xcent)/2.0*scale)+ord('R'))\
-                     +chr(int((x_xmax-x_xcent)/2.0*scale)+ord('R'))
-            result += "\n"
-            continue
+            return self.space, 0
+        index = self.ttf.chr2idx(ch)
+        try:
+            return self.bodies[index]
+        except KeyError:
+            pass
+        with self.lock:
+            if index not in self.bodies:
+                # compile the glyph first, so that "encode" times only
+                # the encoding and not the glyph and flatten stages
+                glyph = self.ttf.glyphData[index]
+                stats = self.stats
+                t = stats.start("encode") if stats else None
+                self.bodies[index] = hersheybody(self.ttf,index,self.kern,self.scale,
+                                                 self.simplify,self.optimize,self.travel)
+                if stats: stats.stop("encode",t,ch)
+                contours = [c for c in glyph['poly'] if len(c)]
+                self.vertices += sum(len(c)+1 for c in contours)
+                self.simplified += (len(self.bodies[index][0])-2)/2-max(len(contours)-1,0)
+                if self.cacheSize and len(self.bodies) > self.cacheSize:
+                    self.bodies.popitem(last=False)
+            return self.bodies[index]
+
+    def records(self,text):
+        # yield the hershey record of each character in text
+        overflow = []
+        for ch in text:
+            res, clamped = self.body(ch)
+            if clamped:
+                overflow.append(ch)
+            yield hersheyline(ord(ch),res)
+
+        if overflow:
+            warnings.warn("%d glyphs have coordinates outside the Hershey range, clamped: %r"
+                          % (len(overflow),u"".join(overflow)), Warning)
+
+    def convert(self,text):
+        result, seconds = self.timed(text)
+        return result
+
+    def timed(self,text):
+        # convert text, returning the result and how long it took
+        t = time.time()
+        result = "".join(self.records(text))
+        seconds = time.time()-t
+        with self.lock:
+            self.calls += 1
+            self.seconds += seconds
+            self.lastLatency = seconds
+        return result, seconds
+
+    def info(self):
+        with self.lock:
+            return {"calls":self.calls,"seconds":self.seconds,
+                    "mean":self.seconds/self.calls if self.calls else 0.0,
+                    "last":self.lastLatency,"glyphs":len(self.bodies),
+                    "vertices":self.vertices,"simplified":self.simplified,
+                    "travel":self.travel[0],"optimized":self.travel[1]}
+
+def hersheyglyphs(text,font_path="ttf/ubuntu.ttf",kern=0,verbose=True,tolerance=None,
+                  cache_dir=None,stats=None,simplify=None,optimize=False):
+    # yield the hershey record of each character in text, one line at a
+    # time, so output can be consumed before the whole font is done
+    converter = HersheyConverter(font_path,kern=kern,verbose=verbose,tolerance=tolerance,
+                                 cache_dir=cache_dir,stats=stats,simplify=simplify,
+                                 optimize=optimize)
+    return converter.records(text)
+
+def hersheybody(ttf,index,kern,scale,simplify=None,optimize=False,travel=None):
+    # the hershey record of a glyph without its codepoint and length:
+    # left and right bounds followed by the vertices.
+    # returns it with the number of clamped coordinates
+    glyph = ttf.glyphData[index]
+    xmin,ymin,xmax,ymax = glyph['rect']
+    contours = glyph.contours if isinstance(glyph,Glyph) else glyph['poly']
+    width = xmax - xmin
+    xcent = xmin + width/2.0
+
+    vertices, clamped = hersheyencode(contours,xcent,ttf.baseline,scale,simplify,
+                                      optimize,travel)
+    res = chr(int(round((xmin-xcent)*scale))+ord('R')-kern)\
+         +chr(int(round((xmax-xcent)*scale))+ord('R')+kern)+vertices
+    return res, clamped
+
+def hersheyline(code,body):
+    return str(code).rjust(5)+str(len(body)).rjust(3)+body+"\n"
+
+def aliasline(code,target):
+    return str(code).rjust(5)+str(target).rjust(6)+"\n"
+
+def compactrecords(lines):
+    # split hershey records into the first record of each distinct
+    # outline and (codepoint, codepoint of the record it repeats) aliases
+    seen = {}
+    for line in lines:
+        code, body = int(line[:5]), line[8:].rstrip("\n")
+        if body in seen:
+            yield None, (code,seen[body])
+        else:
+            seen[body] = code
+            yield line, None
 
-        res = chr(int(round((xmin-xcent)*scale))+ord('R')-kern)\
-             +chr(int(round((xmax-xcent)*scale))+ord('R')+kern)
-        for i in range(len(polylines)):
-            for _j in range(len(polylines[i])+1):
-                j = _j%len(polylines[i])
-                x,y = polylines[i][j]
-                x = x-xcent
-                y = -(y-ttf.baseline)
-                xs = chr(int(round(x*scale))+ord('R'))
-                ys = chr(int(round(y*scale))+ord('R'))
-                res += xs+ys
-            if i != len(polylines)-1:
-                res += " R"
-        result += str(ord(ch)).rjust(5)+str(len(res)).rjust(3)+res+"\n"
-    print result
+def writehershey(f,text,**kwargs):
+    # stream the hershey font for text into the file object f
+    for line in hersheyglyphs(text,**kwargs):
+        f.write(line)
+
+def writehersheycompact(f,text,aliases=None,**kwargs):
+    # like writehershey, but each distinct outline is written once.
+    # characters repeating an earlier outline are listed as aliases,
+    # written as "codepoint target" lines to the file object aliases
+    # if given, and returned as a list of (codepoint, target).
+    result = []
+    for line, alias in compactrecords(hersheyglyphs(text,**kwargs)):
+        if alias is None:
+            f.write(line)
+        else:
+            result.append(alias)
+            if aliases is not None:
+                aliases.write(aliasline(*alias))
     return result
 
-if __name__ == "__main__":
-    input_path = sys.argv[1]
-    characters = "".join([chr(i) for i in range(32,128)])
-    print tohershey(characters,font_path=input_path,verbose=False)
+def tohershey(text,font_path="ttf/ubuntu.ttf",kern=0,verbose=True,tolerance=None,
+              cache_dir=None,stats=None,simplify=None,optimize=False):
+    return "".join(hersheyglyphs(text,font_path=font_path,kern=kern,verbose=verbose,
+                                 tolerance=tolerance,cache_dir=cache_dir,stats=stats,
+                                 simplify=simplify,optimize=optimize))
+
+def reduction(vertices,simplified):
+    return "simplified %d vertices to %d (-%.1f%%)" % (
+        vertices,simplified,100.0*(vertices-simplified)/vertices if vertices else 0)
+
+def travelreduction(travel,optimized):
+    return "pen-up travel %.0f -> %.0f (-%.1f%%)" % (
+        travel,optimized,100.0*(travel-optimized)/travel if travel else 0)
+
+def find_fonts(inputs):
+    # expand files, directories and glob patterns into font paths,
+    # listing each file once, in the order first seen
+    found = []
+    for p in inputs:
+        if os.path.isdir(p):
+            found += sorted(glob.glob(os.path.join(p,"*.ttf"))+glob.glob(os.path.join(p,"*.ttc")))
+        elif os.path.exists(p):
+            found.append(p)
+        else:
+            found += sorted(glob.glob(p))
+    paths, seen = [], set()
+    for p in found:
+        real = os.path.realpath(p)
+        if real not in seen:
+            seen.add(real)
+            paths.append(p)
+    return paths
+
+def find_members(paths):
+    # expand collections into one (id, name, path, index) per member
+    # font, where the id of a member is <path>#<index>. fonts from
+    # different directories with the same name get a numbered suffix
+    # so that their output files don't overwrite each other.
+    fonts = []
+    names = set()
+    def unique(name):
+        n, i = name, 1
+        while n.lower() in names:
+            i += 1
+            n = "%s-%d" % (name,i)
+        names.add(n.lower())
+        return n
+    for p in paths:
+        name = os.path.splitext(os.path.basename(p))[0]
+        try:
+            offsets = ttfparser.collectionOffsets(ttfparser.mapFile(p))
+        except (IOError,OSError,ValueError):
+            offsets = [0]
+        if offsets == [0]:
+            fonts.append((p,unique(name),p,0))
+        else:
+            fonts += [("%s#%d" % (p,i),unique("%s-%d" % (name,i)),p,i) for i in range(len(offsets))]
+    return fonts
+
+def write_atomic(path,data):
+    # write to a temporary file next to the target, then rename over it
+    # so readers never see a partially written font
+    tmp = path+".tmp"+str(os.getpid())
+    f = open(tmp,"w")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp,path)
+
+# the collection last opened by this worker, so that tasks for
+# other members of it reuse the glyphs already compiled
+_collection = None
 
+def _open_collection(path):
+    global _collection
+    if _collection is None or _collection.path != path:
+        _collection = TrueTypeCollection(path)
+    return _collection
 
+def _convert(task):
+    font, font_path, member, index, text, kern, tolerance, cache_dir, simplify, optimize = task
+    t = time.time()
+    try:
+        converter = HersheyConverter(font_path,kern=kern,verbose=False,tolerance=tolerance,
+                                     cache_dir=cache_dir,simplify=simplify,optimize=optimize,
+                                     index=member,collection=_open_collection(font_path))
+        result = converter.convert(text)
+        info = converter.info()
+        counts = info["vertices"],info["simplified"],info["travel"],info["optimized"]
+        return font, index, True, result, time.time()-t, counts
+    except Exception:
+        return font, index, False, traceback.format_exc(), time.time()-t, (0,0,0.0,0.0)
 
+def batch(inputs,output_dir,text,kern=0,tolerance=None,jobs=None,chunk=1024,cache_dir=None,
+          compact=False,simplify=None,optimize=False,log=sys.stderr):
+    # convert every font found in inputs to output_dir/<name>.hf.txt on a
+    # process pool, and each member of a collection to <name>-<index>.hf.txt.
+    # fonts with more than `chunk` characters are split into several tasks.
+    # failures are reported and do not stop the run.
+    # returns {font_path: error} for the fonts that failed, where the
+    # members of a collection are listed as <path>#<index>.
+    members = find_members(find_fonts(inputs))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    paths = [f for f,_,_,_ in members]
+    names = dict((f,name) for f,name,_,_ in members)
+    chunks = [text[i:i+chunk] for i in range(0,len(text),chunk)] or [""]
+    tasks = [(f,p,m,i,c,kern,tolerance,cache_dir,simplify,optimize)
+             for f,_,p,m in members for i,c in enumerate(chunks)]
+    pending = dict((p,[None]*len(chunks)) for p in paths)
+    elapsed = dict((p,0.0) for p in paths)
+    counts = dict((p,[0,0,0.0,0.0]) for p in paths)
+    failures = {}
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for p,i,ok,result,dt,c in pool.imap_unordered(_convert,tasks):
+            elapsed[p] += dt
+            counts[p] = [a+b for a,b in zip(counts[p],c)]
+            if p in failures:
+                continue
+            if not ok:
+                failures[p] = result
+                log.write("[%s] FAILED after %.2fs\n%s" % (p,elapsed[p],result))
+                continue
+            pending[p][i] = result
+            if None not in pending[p]:
+                name = names[p]
+                out = os.path.join(output_dir,name+".hf.txt")
+                records = "".join(pending.pop(p))
+                if compact:
+                    kept, aliases = [], []
+                    for line, alias in compactrecords(records.splitlines(True)):
+                        if alias is None:
+                            kept.append(line)
+                        else:
+                            aliases.append(aliasline(*alias))
+                    records = "".join(kept)
+                    write_atomic(os.path.join(output_dir,name+".alias.txt"),"".join(aliases))
+                write_atomic(out,records)
+                log.write("[%s] %d glyphs in %.2fs -> %s\n" % (p,len(text),elapsed[p],out))
+                if simplify is not None:
+                    log.write("[%s] %s\n" % (p,reduction(*counts[p][:2])))
+                if optimize:
+                    log.write("[%s] %s\n" % (p,travelreduction(*counts[p][2:])))
+    finally:
+        pool.close()
+        pool.join()
+    log.write("%d fonts converted, %d failed\n" % (len(paths)-len(failures),len(failures)))
+    return failures
+
+def positive(value):
+    # argparse type for distances that must be greater than zero
+    x = float(value)
+    if not x > 0:
+        raise argparse.ArgumentTypeError("must be positive: %r" % value)
+    return x
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        import benchmark
+        sys.exit(benchmark.main(sys.argv[2:]))
+    if sys.argv[1:2] == ["serve"]:
+        import hersheyserver
+        sys.exit(hersheyserver.main(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description="Convert True Type Fonts (.ttf) to Hershey Fonts")
+    parser.add_argument("inputs",nargs="+",help="font file, or with -o: files, directories or globs")
+    parser.add_argument("-o","--output-dir",help="batch mode: write <name>.hf.txt files here")
+    parser.add_argument("-k","--kern",type=int,default=0)
+    parser.add_argument("-t","--tolerance",type=positive,default=None,
+                        help="adaptive curve flattening tolerance, in hershey units")
+    parser.add_argument("-j","--jobs",type=int,default=None,help="worker processes (default: all cores)")
+    parser.add_argument("--chunk",type=int,default=1024,help="characters per task for large fonts")
+    parser.add_argument("--cache-dir",default=None,help="reuse compiled glyphs across runs")
+    parser.add_argument("-s","--simplify",type=float,default=None,
+                        help="drop vertices within this distance of the outline, in hershey units")
+    parser.add_argument("--optimize",action="store_true",
+                        help="reorder contours to shorten pen-up travel")
+    parser.add_argument("--index",type=int,default=0,help="member of a .ttc collection to convert")
+    parser.add_argument("--compact",action="store_true",
+                        help="batch mode: write each distinct outline once, plus <name>.alias.txt")
+    args = parser.parse_args()
+
+    characters = "".join([chr(i) for i in range(32,128)])
+    if args.output_dir is None:
+        converter = HersheyConverter(args.inputs[0],kern=args.kern,verbose=False,
+                                     tolerance=args.tolerance,cache_dir=args.cache_dir,
+                                     simplify=args.simplify,optimize=args.optimize,
+                                     index=args.index)
+        for line in converter.records(characters):
+            sys.stdout.write(line)
+        info = converter.info()
+        if args.simplify is not None:
+            sys.stderr.write(reduction(info["vertices"],info["simplified"])+"\n")
+        if args.optimize:
+            sys.stderr.write(travelreduction(info["travel"],info["optimized"])+"\n")
+    else:
+        failures = batch(args.inputs,args.output_dir,characters,kern=args.kern,
+                         tolerance=args.tolerance,jobs=args.jobs,chunk=args.chunk,
+                         cache_dir=args.cache_dir,compact=args.compact,simplify=args.simplify,
+                         optimize=args.optimize)
+        sys.exit(1 if failures else 0)